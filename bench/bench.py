@@ -0,0 +1,281 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Benchmark harness for the forecast cycle. Runs updateForecast() from
+# rain-bypass.py headless against the local stand-in server, with FakeGPIO
+# and FakeSSD1306 (fakes.py) in place of the hardware, and reports
+# per-stage latency, memory allocated at peak within each stage, and peak
+# process RSS.
+#
+# python3 bench/bench.py [--cycles N] [--fixtures long,short,...] [--zones N] [--mode balance]
+#                        [--poll N] [--save results.json] [--compare results.json [--tolerance 25]]
+#
+# --poll N has a client ask the control socket for status N times a second
+# (0 for as fast as it can) throughout, to compare stage times with and
+# without a monitoring system polling.
+#
+# With --compare the run exits with status 1 if any stage got slower than
+# the saved results by more than --tolerance percent (and 0.5 ms).
+
+import argparse
+import socket
+import multiprocessing
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, benchDir)
+import standin
+from fakes import FakeGPIO, FakeSSD1306
+
+# name: (fixture, extra query string, query string of a second source or None).
+# The second source is api.weather.gov gridpoint data from another stand-in.
+scenarios = {
+    "long": ("long", "", None),
+    "short": ("short", "", None),
+    "malformed": ("malformed", "", None),
+    "slow": ("long", "&delay=0.5&trickle=1.5", None),
+    "revalidated": ("long", "&validators=1", None),
+    "fresh": ("long", "&maxage=3600", None),
+    "hedged": ("long", "&delay=2", ""),
+    "failover": ("short", "", ""),
+}
+
+def loadScript():
+    spec = importlib.util.spec_from_file_location("rainbypass",
+        os.path.join(os.path.dirname(benchDir), "rain-bypass.py"))
+    rb = importlib.util.module_from_spec(spec)
+    with contextlib.redirect_stdout(io.StringIO()): # Missing hardware libraries
+        spec.loader.exec_module(rb)
+    return rb
+
+class Stages:
+    # Wraps module functions to record their run time and, for top-level
+    # stages, the memory allocated at peak while they ran
+    def __init__(self, rb):
+        self.rb, self.times, self.peaks, self.originals = rb, {}, {}, {}
+
+    def wrap(self, stage, name, memory=True):
+        # Times are only kept from cycles run without tracemalloc, which
+        # slows allocation-heavy code several-fold
+        func = self.originals[name] = getattr(self.rb, name)
+        def timed(*args, **kwargs):
+            tracing = tracemalloc.is_tracing()
+            if tracing and memory:
+                start = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+            began = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if not tracing:
+                    self.record(stage, time.perf_counter() - began)
+                elif memory:
+                    peak = tracemalloc.get_traced_memory()[1] - start
+                    self.peaks[stage] = max(self.peaks.get(stage, 0), peak)
+        setattr(self.rb, name, timed)
+
+    def restore(self):
+        for name, func in self.originals.items():
+            setattr(self.rb, name, func)
+
+    def record(self, stage, seconds):
+        if not tracemalloc.is_tracing():
+            self.times.setdefault(stage, []).append(seconds)
+
+    def summary(self):
+        results = {}
+        for stage, times in self.times.items():
+            times = sorted(times)
+            results[stage] = {"mean": 1000 * sum(times) / len(times),
+                              "p95": 1000 * times[min(int(len(times) * 0.95), len(times) - 1)],
+                              "peakKiB": self.peaks.get(stage, 0) / 1024}
+        return results
+
+class StatusPoller(multiprocessing.Process):
+    # Asks for status over one connection until stopped, from its own
+    # process as a monitoring system would, and sends back the latencies
+    def __init__(self, path, rate):
+        multiprocessing.Process.__init__(self, daemon=True)
+        self.path, self.rate = path, rate
+        self.stopped = multiprocessing.Event()
+        self.results, self.sender = multiprocessing.Pipe(False)
+
+    def run(self):
+        latencies = []
+        with socket.socket(socket.AF_UNIX) as client:
+            client.connect(self.path)
+            reader = client.makefile("rb")
+            while not self.stopped.is_set():
+                began = time.perf_counter()
+                client.sendall(b"status\n")
+                reader.readline()
+                latencies.append(time.perf_counter() - began)
+                if self.rate:
+                    self.stopped.wait(1 / self.rate)
+        self.sender.send(latencies)
+
+    def stop(self):
+        self.stopped.set()
+        latencies = self.results.recv()
+        self.join()
+        return latencies
+
+def runScenario(rb, server, name, cycles, stateDir, zoneCount=1, mode="rainfall", hedgeServer=None):
+    fixture, extra, hedge = scenarios[name]
+    rb.getCfgFile = lambda extension="cfg": os.path.join(stateDir, "rain-bypass-3." + extension)
+    # Every scenario uses the same stand-ins, so forget the answer times
+    # earlier ones (such as slow) left for the hedge delay
+    rb.sourceTimes.clear()
+    rb.config.clear()
+    rb.config.update(latValue=40.0, longValue=-75.0, lookAhead=24, lookBehind=48,
+        rainfallLimit=1.0, checkIncrement=3600, displayRefresh=60, valveTimeout=5,
+        sensorDebounce=20, valveHasSensor=True, forceValve=False, valveStagger=0.01,
+        fetchTimeout=10, fetchDeadline=2.5, breakerThreshold=5, breakerCooldown=900,
+        decisionMode=mode, cropCoefficient=0.8, balanceLimit=0.0, hedgeDelay=0.5,
+        hedgeURLs=[] if hedge is None else [hedgeServer.url + "/points/%s,%s?" + hedge], forecastURL=server.url + "/" + fixture + "?lat=%s&lon=%s" + extra)
+    if zoneCount > 1: # All at one forecast point, each on its own pins
+        rb.config["zones"] = [{"name": "zone%i" % i, "rainfallLimit": 0.5 + i % 4,
+            "pins": {"OpenRelay": 100 + 10 * i, "CloseRelay": 101 + 10 * i, "EnabledLED": 102 + 10 * i,
+                     "DisabledLED": 103 + 10 * i, "ClosedSensor": 104 + 10 * i, "OpenSensor": 105 + 10 * i}}
+            for i in range(zoneCount)]
+    rb.buildZones()
+    for zone in rb.zones:
+        zone.update(time=int(time.time()) - 3600, rainForecasted=False,
+            qpf=rb.RainForecast([0.01] * 168, rb.currentHour() - 1), historicalRain=rb.RainHistory(168))
+    rb.groupSites()
+
+    gpio = rb.GPIO = FakeGPIO(valveTravel=0.05, bounces=3, valves=[zone["pins"] for zone in rb.zones])
+    gpio.setup(rb.Pins.DataErrLED, gpio.OUT)
+    for zone in rb.zones:
+        pins = zone["pins"]
+        for pin in (pins.OpenRelay, pins.CloseRelay, pins.EnabledLED, pins.DisabledLED):
+            gpio.setup(pin, gpio.OUT)
+        for pin in (pins.OpenSensor, pins.ClosedSensor):
+            gpio.setup(pin, gpio.IN, pull_up_down=gpio.PUD_UP)
+        gpio.levels[pins.ClosedSensor] = 0
+
+    stages = Stages(rb)
+    for stage, func, memory in (("fetch", "fetchForecast", True),
+            ("parse", "parseForecast", False), ("et", "forecastET", True), ("decide", "processForecast", True),
+            ("valve", "ModifyWatering", True), ("persist", "appendState", True),
+            ("display", "updateOLED", False)):
+        stages.wrap(stage, func, memory)
+
+    finishValveMove = stages.originals["finishValveMove"] = rb.finishValveMove
+    def confirmed(zone, reached):
+        if reached and zone["valveMove"]:
+            stages.record("valve confirm", time.time() - zone["valveMove"]["started"])
+        finishValveMove(zone, reached)
+    rb.finishValveMove = confirmed
+
+    # Timed cycles, then one more under tracemalloc for the memory figures
+    for cycle in range(cycles + 1):
+        if cycle == cycles:
+            tracemalloc.start()
+        with contextlib.redirect_stdout(io.StringIO()):
+            began = time.perf_counter()
+            for site in rb.sites.values():
+                site["breaker"].update(failures=0, openUntil=0) # Each cycle starts with a fresh fetch
+                for zone in site["zones"]:
+                    zone["historicalRain"].clear() # Keep the decision inputs the same each cycle
+                    # Leave the valve between its end stops so every move travels
+                    gpio.levels[zone["pins"].OpenSensor] = gpio.levels[zone["pins"].ClosedSensor] = 1
+                rb.updateForecast(site)
+            # The downloads and then the valve moves finish on the scheduler
+            while any(site["tick"] for site in rb.sites.values()):
+                rb.scheduler.run(until=time.time() + 0.001)
+            stages.record("cycle", time.perf_counter() - began)
+            while any(zone["valveMove"] or zone["pendingMove"] for zone in rb.zones):
+                rb.scheduler.run(until=time.time() + 0.01)
+            stages.record("all valves", time.perf_counter() - began)
+    tracemalloc.stop()
+    stages.restore()
+    for site in rb.sites.values():
+        rb.scheduler.cancel(site["checkEvent"])
+    rb.scheduler.cancel(rb.countdownEvent)
+    return stages.summary(), rb.display[2]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the rain-bypass forecast cycle")
+    parser.add_argument("--cycles", type=int, default=5)
+    parser.add_argument("--fixtures", default=",".join(scenarios))
+    parser.add_argument("--zones", type=int, default=1, help="zones sharing the forecast point")
+    parser.add_argument("--mode", choices=("rainfall", "balance"), default="rainfall",
+        help="decision mode of every zone; balance adds the evapotranspiration stage")
+    parser.add_argument("--poll", type=float, help="status requests per second on the control socket, 0 for flat out")
+    parser.add_argument("--save")
+    parser.add_argument("--compare")
+    parser.add_argument("--tolerance", type=float, default=25)
+    parser.add_argument("--metrics", action="store_true", help="print the metrics endpoint's output after the run")
+    args = parser.parse_args()
+
+    rb = loadScript()
+    server, hedgeServer = standin.serve(), standin.serve()
+    fake = None
+    try:
+        fake = FakeSSD1306()
+        rb.setupOLED(fake)
+    except ImportError: # PIL not installed, run without a display
+        print("PIL not available, display stage skipped")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as stateDir:
+        poller = None
+        if args.poll is not None:
+            rb.getCfgFile = lambda extension="cfg": os.path.join(stateDir, "rain-bypass-3." + extension)
+            with contextlib.redirect_stdout(io.StringIO()):
+                rb.startControl()
+            poller = StatusPoller(rb.getCfgFile("sock"), args.poll)
+            poller.start()
+        for name in args.fixtures.split(","):
+            results[name], outcome = runScenario(rb, server, name, args.cycles, stateDir, args.zones, args.mode,
+                hedgeServer)
+            print("\n%s (%s)" % (name, outcome))
+            print("  %-14s %9s %9s %11s" % ("stage", "mean ms", "p95 ms", "peak KiB"))
+            for stage, result in results[name].items():
+                print("  %-14s %9.2f %9.2f %11.1f" % (stage, result["mean"], result["p95"], result["peakKiB"]))
+        if poller:
+            latencies = sorted(poller.stop())
+            print("\nStatus polls: %i, %.3f ms median, %.3f ms p95" % (len(latencies),
+                1000 * latencies[len(latencies) // 2], 1000 * latencies[int(len(latencies) * 0.95)]))
+
+    print("\nPeak RSS: %i KiB" % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    print("Stand-in served %i request(s), %i bytes, %i not modified; second source %i request(s)" %
+        (server.requests, server.bytesSent, server.notModified, hedgeServer.requests))
+    if fake:
+        if rb.renderer:
+            rb.renderer.flush()
+        print("Display: %i frame(s), %i bytes over I2C" % (rb.renderer.frames, fake.bytesSent))
+    if args.metrics:
+        rb.metrics.collectors.append(rb.collectMetrics)
+        print("\n" + rb.metrics.render(), end="")
+
+    if args.save:
+        with open(args.save, "w") as resultFile:
+            json.dump(results, resultFile, indent=1)
+    if args.compare:
+        with open(args.compare) as baselineFile:
+            baseline = json.load(baselineFile)
+        regressions = []
+        for name, stages in results.items():
+            for stage, result in stages.items():
+                before = baseline.get(name, {}).get(stage)
+                if before and result["mean"] > before["mean"] * (1 + args.tolerance / 100) \
+                        and result["mean"] - before["mean"] > 0.5:
+                    regressions.append("%s/%s: %.2f ms -> %.2f ms" % (name, stage, before["mean"], result["mean"]))
+        for regression in regressions:
+            print("REGRESSION %s" % regression)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Stand-ins for the hardware libraries rain-bypass.py drives, for the
+# benchmarks: FakeGPIO for RPi.GPIO and FakeSSD1306 for
+# adafruit_ssd1306.SSD1306_I2C. Install one as the script's GPIO module, or
+# pass the display to setupOLED().
+
+import threading
+import time
+
+class FakeSSD1306:
+    # Stand-in for adafruit_ssd1306.SSD1306_I2C that keeps the framebuffer
+    # and counts bus traffic instead of talking to hardware
+    def __init__(self, width=128, height=32):
+        self.width, self.height = width, height
+        self.buffer = bytearray(width * height // 8 + 1)
+        self.i2c_device = self
+        self.bytesSent, self.writes = 0, 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def write(self, data):
+        self.bytesSent += len(data)
+        self.writes += 1
+
+    def write_cmd(self, cmd):
+        self.write(bytes((0x80, cmd)))
+
+    def fill(self, color):
+        self.buffer[1:] = (b"\xff" if color else b"\x00") * (len(self.buffer) - 1)
+
+    def image(self, img):
+        # Pack a 1-bit image into the framebuffer, as the driver does;
+        # show() sends it
+        from PIL import Image
+        for page in range(self.height // 8):
+            band = img.crop((0, page * 8, self.width, page * 8 + 8))
+            band = band.transpose(Image.FLIP_TOP_BOTTOM).transpose(Image.TRANSPOSE)
+            self.buffer[1 + page * self.width:1 + (page + 1) * self.width] = band.tobytes()
+
+    def show(self):
+        for cmd in (0x21, 0, self.width - 1, 0x22, 0, self.height // 8 - 1):
+            self.write_cmd(cmd)
+        self.write(b"\x40" + self.buffer[1:])
+
+class FakeGPIO:
+    # Stand-in for RPi.GPIO. Outputs are recorded, inputs are driven with
+    # setInput() and edge callbacks fire like the real library's. With
+    # valveTravel set, each valve in `valves` (objects holding pin numbers,
+    # like rain-bypass.py's Pins) also acts as a motorized valve that
+    # reaches the other end valveTravel seconds after a relay is energized,
+    # with its sensor contact bouncing `bounces` times on arrival.
+    BCM, OUT, IN, PUD_UP, PUD_DOWN = 11, 0, 1, 22, 21
+    RISING, FALLING, BOTH = 31, 32, 33
+
+    def __init__(self, valveTravel=None, bounces=0, valves=()):
+        self.levels, self.detect, self.lastEdge = {}, {}, {}
+        self.valveTravel, self.bounces = valveTravel, bounces
+        self.valves = {}
+        for pins in valves:
+            self.valves[pins.OpenRelay] = self.valves[pins.CloseRelay] = \
+                {"pins": pins, "travel": None, "moves": 0, "direction": None}
+        self.edges = 0 # Edges seen on pins with detection enabled
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None, initial=0):
+        self.levels[pin] = 1 if pull_up_down == self.PUD_UP else int(initial)
+
+    def input(self, pin):
+        return self.levels.get(pin, 1)
+
+    def output(self, pin, value):
+        self.levels[pin] = int(bool(value))
+        if self.valveTravel is not None and pin in self.valves:
+            self.moveValve(self.valves[pin])
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=0):
+        self.detect[pin] = (edge, callback, bouncetime / 1000)
+
+    def remove_event_detect(self, pin):
+        self.detect.pop(pin, None)
+
+    def setInput(self, pin, level):
+        # Change an input, calling its callback if the edge matches and it
+        # is outside the bouncetime window, as RPi.GPIO does
+        old, self.levels[pin] = self.levels.get(pin, 1), level
+        if old == level or pin not in self.detect:
+            return
+        self.edges += 1
+        edge, callback, bouncetime = self.detect[pin]
+        if edge == self.BOTH or (edge == self.FALLING) == (level == 0):
+            now = time.monotonic()
+            if now - self.lastEdge.get(pin, -bouncetime) >= bouncetime:
+                self.lastEdge[pin] = now
+                if callback:
+                    callback(pin)
+
+    def moveValve(self, valve):
+        pins = valve["pins"]
+        opening = self.input(pins.OpenRelay) and not self.input(pins.CloseRelay)
+        closing = self.input(pins.CloseRelay) and not self.input(pins.OpenRelay)
+        direction = "open" if opening else "close" if closing else None
+        if direction == valve["direction"]:
+            return
+        # Any change of relays stops the motor where it is
+        valve["direction"] = direction
+        valve["moves"] += 1
+        if valve["travel"]:
+            valve["travel"].cancel()
+        if not direction:
+            return
+        # Leaving one end releases its sensor straight away
+        self.setInput(pins.ClosedSensor if opening else pins.OpenSensor, 1)
+        valve["travel"] = threading.Timer(self.valveTravel, self.arrive,
+            (valve, pins.OpenSensor if opening else pins.ClosedSensor, valve["moves"]))
+        valve["travel"].daemon = True
+        valve["travel"].start()
+
+    def arrive(self, valve, pin, move):
+        for i in range(self.bounces):
+            if move != valve["moves"]: # Valve sent elsewhere while settling
+                return
+            self.setInput(pin, 0)
+            time.sleep(0.001)
+            self.setInput(pin, 1)
+            time.sleep(0.001)
+        if move == valve["moves"]:
+            self.setInput(pin, 0)
+
+    def pulses(self, pin, tips, interval, closed=0.05, bounces=0):
+        # Pulse generator for a switch to ground such as a rain gauge: `tips`
+        # closures starting `interval` seconds apart, each held `closed`
+        # seconds, the contact bouncing `bounces` times as it makes and as
+        # it breaks. Runs on the calling thread, as the callbacks would on
+        # RPi.GPIO's, and keeps to the schedule rather than drifting.
+        began = time.perf_counter()
+        for i in range(tips):
+            for level, when in ((0, i * interval), (1, i * interval + closed)):
+                time.sleep(max(began + when - time.perf_counter(), 0))
+                for bounce in range(bounces):
+                    self.setInput(pin, level)
+                    self.setInput(pin, 1 - level)
+                self.setInput(pin, level)
@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Lost-count check for the rain gauge input. A pulse generator on FakeGPIO
+# tips a RainGauge in each scenario in turn, its contact bouncing on every
+# make and break and staying closed longer than the debounce, as a gauge's
+# reed switch does, while the main thread stands in for the control loop
+# and drains the tips with collect() as fast as it can. Every tip sent must
+# be counted once. Also reports the time each edge costs the GPIO thread
+# and the longest collect().
+#
+# python3 bench/gauge.py [--scenarios 4:60,10:50,20:25] [--tips 200] [--bounces 3] [--debounce 10]
+#
+# A scenario is tips a second and the milliseconds the contact stays closed
+# on each. Exits with status 1 if any scenario lost or double-counted a
+# tip. A contact closed, or open, for less than --debounce is not counted.
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, benchDir)
+from bench import loadScript
+from fakes import FakeGPIO
+
+def runScenario(rb, rate, closed, tips, bounces, debounce):
+    # Returns tips counted, edges made, seconds per edge on the generator
+    # thread, longest collect() and most tips waiting for one
+    gpio = rb.GPIO = FakeGPIO()
+    gauge = rb.RainGauge(25, 0.01, debounce)
+    gpio.setup(gauge.pin, gpio.IN, pull_up_down=gpio.PUD_UP)
+    gpio.add_event_detect(gauge.pin, gpio.BOTH, callback=gauge.changed)
+    gauge.start()
+
+    generator = {}
+    def generate():
+        began = time.thread_time()
+        gpio.pulses(gauge.pin, tips, 1 / rate, closed=closed, bounces=bounces)
+        generator["cpu"] = time.thread_time() - began
+    thread = threading.Thread(target=generate)
+    thread.start()
+    longest = waiting = 0
+    while thread.is_alive():
+        waiting = max(waiting, len(gauge.tips))
+        began = time.perf_counter()
+        gauge.collect()
+        longest = max(longest, time.perf_counter() - began)
+        time.sleep(0.0005)
+    thread.join()
+    time.sleep(3 * debounce) # Let the last break settle
+    gauge.collect()
+    return sum(gauge.counts.values()), gpio.edges, generator["cpu"] / gpio.edges, longest, waiting
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the rain gauge input for lost tips")
+    parser.add_argument("--scenarios", default="4:60,10:50,20:25",
+        help="tips a second and milliseconds closed, as RATE:CLOSED, comma separated")
+    parser.add_argument("--tips", type=int, default=200, help="tips in each scenario")
+    parser.add_argument("--bounces", type=int, default=3, help="contact bounces at each make and break")
+    parser.add_argument("--debounce", type=int, default=10, help="gaugeDebounce, milliseconds")
+    args = parser.parse_args()
+
+    rb = loadScript()
+    print("%i tips per scenario, %i bounces per edge, %i ms debounce\n" % (args.tips, args.bounces, args.debounce))
+    print("%8s %9s %6s %7s %7s %9s %12s %8s" % ("tips/s", "closed ms", "sent", "counted", "edges", "us/edge",
+        "collect ms", "waiting"))
+    lost = False
+    for scenario in args.scenarios.split(","):
+        rate, closed = (float(value) for value in scenario.split(":"))
+        counted, edges, perEdge, longest, waiting = runScenario(rb, rate, closed / 1000, args.tips, args.bounces,
+            args.debounce / 1000)
+        lost = lost or counted != args.tips
+        print("%8g %9g %6i %7i %7i %9.1f %12.3f %8i%s" % (rate, closed, args.tips, counted, edges, 1000000 * perEdge,
+            1000 * longest, waiting, "" if counted == args.tips else "  LOST %+i" % (counted - args.tips)))
+    sys.exit(1 if lost else 0)
+
+if __name__ == '__main__':
+    main()
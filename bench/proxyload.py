@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Load test for the forecast proxy (rain-bypass.py --proxy). Hundreds of
+# simulated controllers ask for a handful of forecast points at the same
+# moment, as a fleet does at the top of the hour, with the stand-in server
+# as the upstream. Every client uses the controller's own fetchForecast().
+#
+#   direct  each controller fetches and parses the DWML itself
+#   cold    through the proxy, nothing held yet
+#   warm    through the proxy again, every point held
+#   update  through the proxy once the points expire; upstream revalidates
+#
+# python3 bench/proxyload.py [--clients 300] [--points 10] [--delay 0.2]
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, benchDir)
+import standin
+from bench import loadScript
+
+def runRound(rb, url, clients, points):
+    # All clients start together; returns each one's latency, or None on error
+    barrier = threading.Barrier(clients)
+    latencies = [None] * clients
+
+    def client(i):
+        point = (40.0 + 0.1 * (i % points), -75.0)
+        barrier.wait()
+        began = time.perf_counter()
+        try:
+            qpf, qpfTimes, headers = rb.fetchForecast(url % point, 30)
+            if len(qpf) >= 24:
+                latencies[i] = time.perf_counter() - began
+        except Exception:
+            pass
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+def counters(rb, name):
+    return {dict(key).get("result", ""): value for key, value in rb.metrics.series[name].items()}
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the rain-bypass forecast proxy")
+    parser.add_argument("--clients", type=int, default=300)
+    parser.add_argument("--points", type=int, default=10, help="distinct forecast points the clients share")
+    parser.add_argument("--delay", type=float, default=0.2, help="upstream response delay, seconds")
+    args = parser.parse_args()
+
+    rb = loadScript()
+    upstream = standin.serve()
+    upstreamURL = upstream.url + "/long?lat=%s&lon=%s&validators=1&delay=" + str(args.delay)
+    proxy = rb.ForecastProxy(upstreamURL, hold=600)
+    server = rb.serveProxy(proxy, 0)
+    proxyURL = "http://127.0.0.1:%i/qpf?lat=%%s&lon=%%s" % server.server_address[1]
+
+    print("%i clients, %i points, upstream delay %.2f s\n" % (args.clients, args.points, args.delay))
+    print("%-7s %6s %9s %8s %8s %8s %9s  %s" % ("round", "errors", "upstream", "p50 ms", "p95 ms", "max ms",
+        "bytes/req", "proxy"))
+    for name, url in (("direct", upstreamURL), ("cold", proxyURL), ("warm", proxyURL), ("update", proxyURL)):
+        if name == "update":
+            for point in proxy.points.values():
+                point["entry"]["expires"] = 0
+        requests, sent = upstream.requests, upstream.bytesSent
+        received = rb.metrics.series["rainbypass_fetch_bytes_total"].get((), 0)
+        served = counters(rb, "rainbypass_proxy_requests_total")
+        latencies = runRound(rb, url, args.clients, args.points)
+        done = sorted(latency for latency in latencies if latency is not None)
+        # Bytes the clients received, less what the proxy itself downloaded
+        received = rb.metrics.series["rainbypass_fetch_bytes_total"].get((), 0) - received
+        if name != "direct":
+            received -= upstream.bytesSent - sent
+        outcome = counters(rb, "rainbypass_proxy_requests_total")
+        outcome = ", ".join("%s %i" % (result, hits - served.get(result, 0))
+            for result, hits in sorted(outcome.items()) if hits > served.get(result, 0))
+        if not done:
+            print("%-7s %6i %9i  (no successful requests)" % (name, len(latencies), upstream.requests - requests))
+            continue
+        print("%-7s %6i %9i %8.1f %8.1f %8.1f %9i  %s" % (name, len(latencies) - len(done),
+            upstream.requests - requests, 1000 * done[len(done) // 2],
+            1000 * done[min(int(len(done) * 0.95), len(done) - 1)], 1000 * done[-1],
+            received / len(latencies), outcome or "-"))
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
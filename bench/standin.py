@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Local stand-in for forecast.weather.gov, serving the recorded responses in
+# bench/fixtures so the forecast path can be exercised without the network.
+#
+# GET /<fixture>?lat=..&lon=..[&delay=s][&trickle=s][&validators=1][&maxage=s]
+# returns fixtures/<fixture>.xml, gzipped when the client asks for it. delay
+# holds the response back before the headers; trickle spreads the body out
+# over that many seconds. validators adds an ETag and Last-Modified and
+# answers matching conditional requests with 304; maxage sends
+# Cache-Control: max-age. The fixture's times are moved so its first hour
+# is the current one.
+#
+# GET /points/<lat>,<lon> and /gridpoints/<office>/<x>,<y> stand in for
+# api.weather.gov: the points lookup links to the gridpoint data, which is
+# fixtures/gridpoints.json, and passes on its query string, so the same
+# options apply to it.
+#
+# Run on its own with: python3 bench/standin.py [port]
+
+import email.utils
+import gzip
+import json
+import os
+import re
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, parse_qs
+
+fixtureDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+validTime = re.compile(rb"(<(?:start|end)-valid-time>|\"validTime\": ?\")(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)([+-]\d\d:\d\d)")
+
+def currentTimes(body):
+    # Shift every valid time by whole hours so the first one is this hour
+    first = validTime.search(body)
+    if not first:
+        return body
+    start = datetime.fromisoformat((first.group(2) + first.group(3)).decode())
+    shift = timedelta(hours=int(time.time() // 3600) - int(start.timestamp() // 3600))
+    def moved(match):
+        when = datetime.fromisoformat((match.group(2) + match.group(3)).decode()) + shift
+        return match.group(1) + when.strftime("%Y-%m-%dT%H:%M:%S").encode() + match.group(3)
+    return validTime.sub(moved, body)
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        self.server.requests += 1
+        path = url.path.strip("/")
+        fixturePath = os.path.join(fixtureDir, "gridpoints.json" if path.startswith("gridpoints/") else path + ".xml")
+        contentType = "application/geo+json" if path.startswith(("points/", "gridpoints/")) else "application/xml"
+        try:
+            if path.startswith("points/"):
+                body = json.dumps({"properties": {"gridId": "TST", "gridX": 10, "gridY": 20,
+                    "forecastGridData": self.server.url + "/gridpoints/TST/10,20" +
+                    ("?" + url.query if url.query else "")}}).encode()
+                fixturePath = None # Nothing to revalidate
+            else:
+                with open(fixturePath, "rb") as fixture:
+                    body = currentTimes(fixture.read())
+        except OSError:
+            self.send_error(404)
+            return
+
+        time.sleep(float(query.get("delay", [0])[0]))
+        validators = {}
+        if query.get("validators") and fixturePath:
+            validators["ETag"] = '"%08x"' % zlib.crc32(body)
+            validators["Last-Modified"] = email.utils.formatdate(os.path.getmtime(fixturePath), usegmt=True)
+        if validators and self.headers.get("If-None-Match") == validators["ETag"]:
+            self.server.notModified += 1
+            self.send_response(304)
+            for name, value in validators.items():
+                self.send_header(name, value)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", contentType)
+        for name, value in validators.items():
+            self.send_header(name, value)
+        if query.get("maxage"):
+            self.send_header("Cache-Control", "max-age=%s" % query["maxage"][0])
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        trickle = float(query.get("trickle", [0])[0])
+        chunks = 10 if trickle else 1
+        size = -(-len(body) // chunks)
+        try:
+            for i in range(chunks):
+                self.wfile.write(body[i * size:(i + 1) * size])
+                self.wfile.flush()
+                if trickle:
+                    time.sleep(trickle / chunks)
+        except (BrokenPipeError, ConnectionResetError): # Client gave up
+            return
+        self.server.bytesSent += len(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class StandInServer(ThreadingHTTPServer):
+    request_queue_size = 256 # Load tests open hundreds of connections at once
+    daemon_threads = True
+
+def serve(port=0):
+    # Start the stand-in on a background thread; returns the server, with
+    # server.url set to its base address
+    server = StandInServer(("127.0.0.1", port), StandInHandler)
+    server.requests, server.bytesSent, server.notModified = 0, 0, 0
+    server.url = "http://127.0.0.1:%i" % server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == '__main__':
+    server = serve(int(sys.argv[1]) if len(sys.argv) > 1 else 8080)
+    print("Serving %s on %s" % (fixtureDir, server.url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
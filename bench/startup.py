@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Time from starting rain-bypass.py to its first valve decision, from saved
+# state. Each run copies the script into a scratch directory next to a
+# config whose last check was ten minutes ago, starts it, and waits for the
+# first "Watering" line.
+#
+# python3 bench/startup.py [--runs N] [--baseline OLD_SCRIPT] [--timeout 120]
+#
+# --baseline times another copy of the script the same way, for comparing
+# against an earlier startup path, e.g. git show <rev>:rain-bypass.py > old.py
+# The current script runs with --headless; the baseline runs with no
+# arguments, which off the Pi also means without GPIO or a display.
+
+import argparse
+import json
+import os
+import selectors
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+
+def savedConfig():
+    # All-in-one config file, which every version of the script reads
+    return {"latValue": "40.0", "longValue": "-75.0", "lookAhead": 24, "lookBehind": 48,
+            "rainfallLimit": 1.0, "checkIncrement": 3600, "valveHasSensor": False, "forceValve": False,
+            "forecastURL": "http://127.0.0.1:9/?lat=%s&lon=%s",
+            "time": int(time.time()) - 600, "rainForecasted": False,
+            "qpf": [0.01] * 168, "historicalRain": [0.0] * 48}
+
+def timeStartup(script, args, timeout):
+    # Seconds until the first decision, or None if none came within timeout
+    with tempfile.TemporaryDirectory() as runDir:
+        shutil.copy(script, os.path.join(runDir, "rain-bypass.py"))
+        with open(os.path.join(runDir, "rain-bypass-3.cfg"), "w") as configFile:
+            json.dump(savedConfig(), configFile)
+        began = time.perf_counter()
+        process = subprocess.Popen([sys.executable, "-u", os.path.join(runDir, "rain-bypass.py")] + args,
+            cwd=runDir, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        selector = selectors.DefaultSelector()
+        selector.register(process.stdout, selectors.EVENT_READ)
+        decided, pending = None, b""
+        try:
+            while decided is None and time.perf_counter() - began < timeout:
+                if not selector.select(timeout - (time.perf_counter() - began)):
+                    break
+                data = os.read(process.stdout.fileno(), 65536)
+                if not data:
+                    break
+                pending += data
+                if b"Watering" in pending:
+                    decided = time.perf_counter() - began
+                pending = pending[-64:]
+        finally:
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        return decided
+
+def report(name, script, args, runs, timeout):
+    times = [timeStartup(script, args, timeout) for i in range(runs)]
+    done = [seconds for seconds in times if seconds is not None]
+    if not done:
+        print("%-9s no decision within %i seconds" % (name, timeout))
+        return
+    print("%-9s first decision after %.3f s median, %.3f s max%s" % (name, statistics.median(done), max(done),
+        "" if len(done) == runs else " (%i of %i runs timed out)" % (runs - len(done), runs)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Time rain-bypass.py from start to first valve decision")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--baseline", help="another copy of rain-bypass.py to time the same way")
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+
+    report("current", os.path.join(os.path.dirname(benchDir), "rain-bypass.py"), ["--headless"],
+        args.runs, args.timeout)
+    if args.baseline:
+        report("baseline", args.baseline, [], args.runs, args.timeout)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Confirmation check for the valve position sensors. Each scenario starts a
+# valve move with ModifyWatering() and plays a sequence of contact changes
+# into the end-stop sensor through FakeGPIO, so they reach
+# valveSensorEdge() and checkValveSensor() as real edges would, while the
+# main thread runs the scheduler as the control loop does. A move must be
+# confirmed sensorDebounce ms after the contact last settled closed, and
+# not on a bounce or on a contact shorter than that; a contact that never
+# settles closed must end in the valveTimeout failure instead.
+#
+# python3 bench/valves.py [--debounce 20] [--timeout 1] [--slack 30] [--repeat 3]
+#
+# Exits with status 1 if any move was confirmed early, missed or confirmed
+# (or timed out) late by more than --slack ms.
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, benchDir)
+from bench import loadScript
+from fakes import FakeGPIO
+
+def bounce(at, count, gap, settle):
+    # Contact changes from `at` seconds: `count` bounces `gap` seconds
+    # apart, then staying at `settle`
+    steps = []
+    for i in range(count):
+        steps += [(at + 2 * i * gap, 0), (at + (2 * i + 1) * gap, 1)]
+    return steps + [(at + 2 * count * gap, settle)]
+
+def scenarios(debounce):
+    # name: (contact changes as (seconds into the move, level), whether the
+    # move is confirmed, seconds the contact last settled closed or None)
+    short = debounce / 4 # A contact well inside the debounce
+    return {
+        "clean": ([(0.1, 0)], True, 0.1),
+        "bouncing": (bounce(0.1, 10, 0.001, 0), True, 0.12),
+        "slow bounce": (bounce(0.1, 4, debounce / 2, 0), True, 0.1 + 4 * debounce),
+        "short contact": ([(0.1, 0), (0.1 + short, 1), (0.3, 0)], True, 0.3),
+        "bounce, short": (bounce(0.1, 5, 0.001, 1) + [(0.2, 0), (0.2 + short, 1), (0.3, 0)], True, 0.3),
+        "short only": ([(0.1, 0), (0.1 + short, 1)], False, None),
+        "bounce, open": (bounce(0.1, 10, 0.001, 1), False, None),
+        "no contact": ([], False, None),
+    }
+
+def runMove(rb, zone, steps):
+    # Plays `steps` into the open sensor during one opening move. Returns
+    # how the move finished and when, in seconds since it started.
+    gpio, pin = rb.GPIO, zone["pins"].OpenSensor
+    result = {}
+    finishValveMove = rb.finishValveMove
+    def finished(zone, reached):
+        if reached is not None and zone["valveMove"]:
+            result.update(reached=reached, at=time.time() - zone["valveMove"]["started"])
+        finishValveMove(zone, reached)
+    rb.finishValveMove = finished
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            rb.ModifyWatering(zone, False)
+            started = zone["valveMove"]["started"]
+            def play():
+                for at, level in steps:
+                    time.sleep(max(started + at - time.time(), 0))
+                    gpio.setInput(pin, level)
+            thread = threading.Thread(target=play)
+            thread.start()
+            rb.scheduler.run(until=started + zone["valveTimeout"] + 1, done=lambda: result)
+            thread.join()
+            if zone["valveMove"]: # Neither confirmed nor timed out
+                finishValveMove(zone, None)
+    finally:
+        rb.finishValveMove = finishValveMove
+        gpio.setInput(pin, 1) # Back between the end stops
+    return result.get("reached"), result.get("at")
+
+def main():
+    parser = argparse.ArgumentParser(description="Check valve move confirmation from bouncing sensors")
+    parser.add_argument("--debounce", type=int, default=20, help="sensorDebounce, milliseconds")
+    parser.add_argument("--timeout", type=int, default=1, help="valveTimeout, seconds")
+    parser.add_argument("--slack", type=float, default=30, help="milliseconds a result may come after it is due")
+    parser.add_argument("--repeat", type=int, default=3, help="moves in each scenario")
+    args = parser.parse_args()
+
+    rb = loadScript()
+    stateDir = tempfile.mkdtemp() # Keep the zone's archive out of the tree
+    rb.getCfgFile = lambda extension="cfg": os.path.join(stateDir, "rain-bypass-3." + extension)
+    rb.config.update(latValue=40.0, longValue=-75.0, lookAhead=24, lookBehind=48, rainfallLimit=1.0,
+        valveTimeout=args.timeout, sensorDebounce=args.debounce, valveHasSensor=True, forceValve=False,
+        decisionMode="rainfall", cropCoefficient=0.8, balanceLimit=0.0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        rb.buildZones()
+    zone = rb.zones[0]
+    zone.update(rainForecasted=False, time=int(time.time()))
+    gpio = rb.GPIO = FakeGPIO()
+    for pin in (zone["pins"].OpenRelay, zone["pins"].CloseRelay, zone["pins"].EnabledLED,
+            zone["pins"].DisabledLED):
+        gpio.setup(pin, gpio.OUT)
+    for pin in (zone["pins"].OpenSensor, zone["pins"].ClosedSensor):
+        gpio.setup(pin, gpio.IN, pull_up_down=gpio.PUD_UP)
+
+    debounce, slack = args.debounce / 1000, args.slack / 1000
+    print("%i ms debounce, %i s timeout, %i move(s) per scenario\n" % (args.debounce, args.timeout, args.repeat))
+    print("%-14s %9s %9s %9s %9s" % ("scenario", "expected", "due ms", "got", "latest ms"))
+    failed = False
+    for name, (steps, confirms, settled) in scenarios(debounce).items():
+        due = settled + debounce if confirms else args.timeout
+        latest, verdict = 0, ""
+        for i in range(args.repeat):
+            reached, at = runMove(rb, zone, steps)
+            if reached is None:
+                verdict = verdict or "MISSED"
+            elif reached != confirms:
+                verdict = verdict or ("EARLY" if reached else "MISSED")
+            elif at < due:
+                verdict = verdict or "EARLY"
+            elif at > due + slack:
+                verdict = verdict or "LATE"
+            latest = max(latest, at or 0)
+        failed = failed or bool(verdict)
+        print("%-14s %9s %9.1f %9s %9.1f%s" % (name, "moved" if confirms else "timeout", 1000 * due,
+            "moved" if reached else "none" if reached is None else "timeout", 1000 * latest,
+            "  " + verdict if verdict else ""))
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
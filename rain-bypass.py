@@ -38,9 +38,10 @@
 # 8. To run automatically at startup, change permission of this file to execute:
 # sudo chmod +x rain-bypass.py
 # 9.Edit cron file using "crontab -e" and add
-# @reboot sleep 60 && /usr/bin/screen -d -m /home/pi/python/rain-bypass.py
+# @reboot /usr/bin/screen -d -m /home/pi/python/rain-bypass.py
 #
-# This will start the script 60 seconds after boot. The script output can be
+# This will start the script at boot. It sets the valves from its saved state
+# straight away, then waits for the network itself. The script output can be
 # accessed via terminal or SSH by typing "screen -r". If you wish to connect
 # remotely, and are using the desktop version of Raspberry Pi OS, make sure to
 # disable power saving by adding the following to
@@ -48,9 +49,6 @@
 #
 # @xset s off
 # @xset -dpms
-#
-# To do:
-# # Debounce valve sensor input
 
 class Pins:
     OpenRelay = 17      # These pins control the valve.
@@ -63,39 +61,560 @@ class Pins:
     ClosedSensor = 23   # Valve closed when 0
     OpenSensor = 24     # Valve open when 0
     
-    BypassEnable = 0    # Force enable watering (not implemented)
-    BypassDisable = 0   # Force disable watering (not implemented)
+    BypassEnable = 0    # Switch to ground to force enable watering (0 for none)
+    BypassDisable = 0   # Switch to ground to force disable watering (0 for none)
+    RainGauge = 0       # Tipping-bucket rain gauge, switch to ground on each tip (0 for none)
 
-import urllib.request
-import subprocess
+import urllib.error
+import urllib.parse
+import http.client
+import http.server
+import queue
+import gzip
 import socket
+import socketserver
 import json 
 import os
+import contextlib
 import time
+import heapq
+import math
+import mmap
+import struct
+import argparse
+import csv
+import random
+import re
+import email.utils
+import zlib
+import threading
+import traceback
+from array import array
+from collections import deque
+from datetime import datetime, timezone
+from itertools import accumulate, count
 from signal import signal, SIGINT
 from sys import exit
 try:
     import xml.etree.cElementTree as ET
 except ImportError:
     import xml.etree.ElementTree as ET
-try:
-    import RPi.GPIO as GPIO #Import GPIO library
-except Exception as error:
-    print(error)
-
-# imports for piOLED screen
-try:
-    from board import SCL, SDA
-    import busio
-    import adafruit_ssd1306
-    from PIL import Image, ImageDraw, ImageFont
-except Exception as error:
-    print(error)
+# GPIO, the OLED driver, PIL and NumPy are imported only when a backend
+# needs them: setupGPIO(), setupDisplay(), setupOLED(), runReplay() and
+# forecastET()
+GPIO = None
+np = None
+Image = ImageDraw = ImageFont = None
 
 
 config = {}             # Hold configuration
+defaultForecastURL = "https://forecast.weather.gov/MapClick.php?lat=%s&lon=%s&FcstType=digitalDWML"
+gridpointsURL = "https://api.weather.gov/points/%s,%s" # Followed to the point's forecastGridData
 display = [None, "","","","", None, None, None] # Hold display output
-firstRun = True # Always run valve on first run
+
+# Rain amounts are held as whole micro-inches, so window sums are exact and
+# the decision depends only on the values in the window, never on the order
+# they were added in (which keeps the replay engine bit-for-bit identical)
+def toMicro(inches):
+    return int(round(inches * 1000000))
+
+class RainHistory:
+    # Hourly rain amounts keyed by absolute hour (unix time // 3600), in a
+    # ring of `capacity` buckets ending at the newest hour. A Fenwick tree
+    # over the ring gives any window sum in O(log n), and recording an hour
+    # again (several checks in one hour) overwrites its bucket.
+    def __init__(self, capacity=168, values=(), hour=0):
+        self.capacity = capacity
+        self.values = array('q', [0]) * capacity
+        self.tree = array('q', [0]) * (capacity + 1)
+        self.clear()
+        values = list(values)[-capacity:] # oldest first, the last one at `hour`
+        for i, value in enumerate(values):
+            self.record(hour - len(values) + 1 + i, value)
+
+    def clear(self):
+        self.newest = None # hour of newest entry
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i): # i = 0 is the newest entry
+        if not 0 <= i < self.length:
+            raise IndexError("RainHistory index out of range")
+        return self.values[(self.newest - i) % self.capacity] / 1000000
+
+    def __iter__(self):
+        for i in range(self.length):
+            yield self.values[(self.newest - i) % self.capacity] / 1000000
+
+    def record(self, hour, value):
+        # Set one hour's rain. The hours held must be unbroken, so an hour
+        # after a gap starts the history over.
+        if self.length and self.newest - self.length < hour <= self.newest:
+            pass # Overwrite
+        elif self.length and hour == self.newest + 1:
+            self.newest, self.length = hour, min(self.length + 1, self.capacity)
+        elif self.length and hour <= self.newest - self.length:
+            return # Older than anything held
+        else:
+            self.newest, self.length = hour, 1
+        i = hour % self.capacity
+        micro = toMicro(value)
+        delta, self.values[i] = micro - self.values[i], micro
+        i += 1
+        while i <= self.capacity: # Fenwick tree update
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix(self, i):
+        # Total of ring buckets 0..i-1
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def sum(self, first, last):
+        # Total of hours first..last-1 in micro-inches, clipped to the hours held
+        if not self.length:
+            return 0
+        first, last = max(first, self.newest - self.length + 1), min(last, self.newest + 1)
+        if first >= last:
+            return 0
+        start, end = first % self.capacity, last % self.capacity or self.capacity
+        if start < end:
+            return self.prefix(end) - self.prefix(start)
+        return self.prefix(self.capacity) - self.prefix(start) + self.prefix(end)
+
+class RainForecast:
+    # Hourly forecast keyed by absolute hour (unix time // 3600), starting
+    # at the start-valid-time of its first value. Prefix sums make any
+    # window sum O(1); as time passes, queries just start at a later hour.
+    def __init__(self, values=(), hour=0, capacity=168):
+        self.values = array('q', [0]) * capacity
+        self.sums = array('q', [0]) * (capacity + 1)
+        self.load(values, hour)
+
+    def load(self, values, hour):
+        if len(values) > len(self.values):
+            self.values = array('q', [0]) * len(values)
+            self.sums = array('q', [0]) * (len(values) + 1)
+        for i, value in enumerate(values):
+            self.values[i] = toMicro(value)
+        for i, total in enumerate(accumulate(self.values[:len(values)]), 1):
+            self.sums[i] = total
+        self.first, self.length = hour, len(values)
+
+    def clear(self):
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for value in self.values[:self.length]:
+            yield value / 1000000
+
+    @property
+    def end(self): # hour after the last one forecast
+        return self.first + self.length
+
+    def at(self, hour):
+        # Rain forecast for one hour, or None outside the forecast
+        if not self.first <= hour < self.end:
+            return None
+        return self.values[hour - self.first] / 1000000
+
+    def remaining(self, hour):
+        # Hours forecast from `hour` on, counting `hour` itself
+        return max(self.end - hour, 0)
+
+    def series(self, hour):
+        # Values from `hour` to the end, 0.0 for any hours before the first
+        return [0.0] * max(self.first - hour, 0) + \
+            [value / 1000000 for value in self.values[max(hour - self.first, 0):self.length]]
+
+    def sum(self, first, last):
+        # Total of hours first..last-1 in micro-inches, clipped to the
+        # available forecast
+        first = min(max(first - self.first, 0), self.length)
+        last = min(max(last - self.first, 0), self.length)
+        return self.sums[last] - self.sums[first]
+
+class RainArchive:
+    # Long-term hourly record of one zone, in a file of fixed records
+    # indexed by absolute hour from the first hour recorded: one float32
+    # per series per hour, NaN where nothing was recorded. A record is
+    # written in place, so appending is O(1) and nothing is kept in memory;
+    # read() maps the file, so a range is a zero-copy NumPy view and only
+    # the pages it touches are loaded.
+    series = ("forecast", "observed", "rainRate", "disabled")
+    header = struct.Struct("<4sHxxq") # magic, series per record, first hour
+    chunk = 4096                      # records written at once filling a gap
+
+    def __init__(self, path, create=True):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | (os.O_CREAT if create else 0), 0o644)
+        self.row = struct.Struct("<%if" % len(self.series))
+        self.empty = self.row.pack(*[math.nan] * len(self.series))
+        self.first = None
+        data = os.pread(self.fd, self.header.size, 0)
+        if len(data) == self.header.size:
+            magic, count, self.first = self.header.unpack(data)
+            if magic != b"RBA1" or count != len(self.series):
+                os.close(self.fd)
+                raise ValueError("%s is not a rain archive" % path)
+
+    def close(self):
+        os.close(self.fd)
+
+    def __len__(self): # hours held, from self.first on
+        if self.first is None:
+            return 0
+        return (os.fstat(self.fd).st_size - self.header.size) // self.row.size
+
+    def record(self, hour, **values):
+        # Set some series for one hour; the others keep their values.
+        # Hours before the first one held are not kept.
+        if self.first is None:
+            self.first = hour
+            os.pwrite(self.fd, self.header.pack(b"RBA1", len(self.series), hour), 0)
+        index, length = hour - self.first, len(self)
+        if index < 0:
+            return
+        for start in range(length, index, self.chunk): # Hours missed read as NaN
+            os.pwrite(self.fd, self.empty * min(index - start, self.chunk),
+                self.header.size + start * self.row.size)
+        offset = self.header.size + index * self.row.size
+        record = list(self.row.unpack(os.pread(self.fd, self.row.size, offset)
+            if index < length else self.empty))
+        for name, value in values.items():
+            record[self.series.index(name)] = math.nan if value is None else value
+        os.pwrite(self.fd, self.row.pack(*record), offset)
+
+    def read(self, first=None, last=None):
+        # Hours first..last-1, clipped to the hours held, as a read-only
+        # (hours, series) float32 view; returns the hour of its first row
+        # and the view. Needs NumPy (np).
+        length = len(self)
+        start = 0 if first is None or self.first is None else min(max(first - self.first, 0), length)
+        end = length if last is None or self.first is None else min(max(last - self.first, start), length)
+        hour = (self.first or 0) + start
+        if end == start:
+            return hour, np.empty((0, len(self.series)), np.float32)
+        offset = self.header.size + start * self.row.size
+        aligned = offset - offset % mmap.ALLOCATIONGRANULARITY
+        view = mmap.mmap(self.fd, self.header.size + end * self.row.size - aligned,
+            access=mmap.ACCESS_READ, offset=aligned)
+        return hour, np.frombuffer(view, np.dtype("<f4"), (end - start) * len(self.series),
+            offset - aligned).reshape(end - start, len(self.series))
+
+class RainGauge:
+    # Tipping-bucket rain gauge on a GPIO input. Edges on either side of
+    # the contact wake the gauge's own thread, which re-reads the pin once
+    # it has had `debounce` seconds to settle; only a confirmed change from
+    # open to closed is a tip, so bounce as the contact makes or breaks is
+    # never counted. That thread appends the time of each tip to a deque,
+    # and the control thread drains it with collect() and bins the tips by
+    # hour. Appending and popping at opposite ends of a deque are atomic,
+    # so neither side takes a lock and a storm of tips never waits on, or
+    # holds up, the control loop.
+    def __init__(self, pin, resolution, debounce=0.01, started=None):
+        self.pin, self.resolution, self.debounce = pin, resolution, debounce
+        self.tips = deque()
+        self.counts = {} # hour -> tips collected
+        self.started = time.time() if started is None else started
+        self.first = int(self.started // 3600) + 1 # first hour measured whole
+        self.closed = False
+        self.edge = threading.Event()
+
+    def start(self):
+        # Once the pin is set up and its edges call changed()
+        self.closed = not GPIO.input(self.pin)
+        threading.Thread(target=self.settle, daemon=True).start()
+
+    def changed(self, channel):
+        self.edge.set()
+
+    def settle(self):
+        # Read the contact `debounce` seconds after an edge, and again after
+        # any edges that came meanwhile. This runs on its own thread, not the
+        # scheduler as bypassChanged() does, so a busy control loop cannot
+        # miss a short closure.
+        while True:
+            self.edge.wait()
+            self.edge.clear()
+            time.sleep(self.debounce)
+            closed = not GPIO.input(self.pin)
+            if closed and not self.closed:
+                self.tips.append(time.time())
+            self.closed = closed
+
+    def collect(self):
+        # Move the tips so far into their hours, keeping a week of them
+        tips, counts = self.tips, self.counts
+        collected = len(tips)
+        for i in range(collected):
+            hour = int(tips.popleft() // 3600)
+            counts[hour] = counts.get(hour, 0) + 1
+        if collected:
+            metrics.inc("rainbypass_gauge_tips_total", collected, pin=str(self.pin))
+            for hour in [hour for hour in counts if hour <= max(counts) - 168]:
+                del counts[hour]
+        return collected
+
+    def rain(self, hour):
+        # Inches measured in an hour, as of the last collect()
+        return self.counts.get(hour, 0) * self.resolution
+
+class Scheduler:
+    # Deadline-based timer heap. run() sleeps until the next due event rather
+    # than polling, and at() may be called from other threads to wake it.
+    def __init__(self):
+        self.events = []
+        self.counter = count()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.wakeups = 0
+        self.lastStats = (time.time(), time.process_time(), 0)
+
+    def at(self, when, action, *args):
+        event = [when, next(self.counter), action, args]
+        with self.lock:
+            heapq.heappush(self.events, event)
+        self.wake.set()
+        return event
+
+    def after(self, delay, action, *args):
+        return self.at(time.time() + delay, action, *args)
+
+    def cancel(self, event):
+        if event:
+            event[2] = None # Dropped when it reaches the top of the heap
+
+    def run(self, until=None, done=None):
+        # Serve events until the time `until`, or until done() is true
+        while (until is None or time.time() < until) and not (done and done()):
+            self.wake.clear()
+            event, delay = self.next()
+            if event:
+                try:
+                    event[2](*event[3])
+                except Exception:
+                    # A failing event is reported and dropped; the others,
+                    # and the controller, carry on
+                    print("Error in %s:" % getattr(event[2], "__name__", "scheduled event"))
+                    traceback.print_exc()
+                continue
+            if until is not None:
+                delay = min(until - time.time(), delay if delay is not None else until)
+            self.wake.wait(delay)
+            self.wakeups += 1
+
+    def next(self):
+        # Pop the next due event, or return how long until one is due
+        with self.lock:
+            while self.events and self.events[0][2] is None:
+                heapq.heappop(self.events)
+            if not self.events:
+                return None, None
+            delay = self.events[0][0] - time.time()
+            if delay <= 0:
+                return heapq.heappop(self.events), 0
+            return None, delay
+
+    def stats(self):
+        # Wakeups and CPU use since the last call
+        now, cpu, wakeups = time.time(), time.process_time(), self.wakeups
+        lastNow, lastCpu, lastWakeups = self.lastStats
+        self.lastStats = (now, cpu, wakeups)
+        return wakeups - lastWakeups, 100 * (cpu - lastCpu) / max(now - lastNow, 1)
+
+class Metrics:
+    # Counters, gauges and histograms for the metrics endpoint, rendered in
+    # the Prometheus text format. Safe to update from any thread. Collectors
+    # copy in values kept elsewhere each time the endpoint is read.
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) # seconds
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds = {}   # name -> (type, help text)
+        self.series = {}  # name -> {labels: value, or bucket counts + [sum, count]}
+        self.collectors = []
+
+    def describe(self, name, kind, text):
+        self.kinds[name] = (kind, text)
+        self.series[name] = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series[name]
+            series[key] = series.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.series[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series[name]
+            counts = series.get(key)
+            if counts is None:
+                counts = series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def render(self):
+        for collect in self.collectors:
+            try:
+                collect()
+            except Exception as error:
+                print(error)
+        lines = []
+        with self.lock:
+            for name in sorted(self.series):
+                kind, text = self.kinds[name]
+                lines += ["# HELP %s %s" % (name, text), "# TYPE %s %s" % (name, kind)]
+                for key, value in sorted(self.series[name].items()):
+                    if kind != "histogram":
+                        lines.append("%s%s %s" % (name, formatLabels(key), value))
+                        continue
+                    for bound, hits in zip(self.buckets + ("+Inf",), value[:-2] + value[-1:]):
+                        lines.append("%s_bucket%s %s" % (name, formatLabels(key + (("le", str(bound)),)), hits))
+                    lines.append("%s_sum%s %s" % (name, formatLabels(key), value[-2]))
+                    lines.append("%s_count%s %s" % (name, formatLabels(key), value[-1]))
+        return "\n".join(lines) + "\n"
+
+def formatLabels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"')
+        .replace("\n", "\\n")) for name, value in labels)
+
+class OLEDRenderer(threading.Thread):
+    # Draws display lines 1-4 on its own thread so the control loop never
+    # waits on I2C. Only lines that changed are re-rasterized, only the
+    # display pages they cover are sent, and frames are capped at maxFps.
+    lineTops = (-2, 6, 14, 22) # y position of each text line
+
+    def __init__(self, disp, image, draw, font, maxFps=4):
+        threading.Thread.__init__(self, daemon=True)
+        self.disp, self.image, self.draw, self.font = disp, image, draw, font
+        self.frameTime = 1.0 / maxFps
+        try: # Rows covered by the tallest glyphs, including descenders
+            self.lineHeight = font.getbbox("\u00c5gjy|")[3]
+        except Exception:
+            self.lineHeight = 11
+        self.shown = [None, None, None, None] # Lines currently on the panel
+        self.pending = None
+        self.busy = False
+        self.frames, self.bytesSent = 0, 0
+        self.cond = threading.Condition()
+
+    def update(self, lines):
+        # Queue the latest lines; anything not yet drawn is superseded
+        with self.cond:
+            self.pending = list(lines)
+            self.cond.notify_all()
+
+    def flush(self, timeout=2):
+        # Wait until the queued lines are on the panel
+        with self.cond:
+            self.cond.wait_for(lambda: self.pending is None and not self.busy, timeout)
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending is not None)
+                lines, self.pending, self.busy = self.pending, None, True
+            try:
+                self.render(lines)
+            except Exception as error:
+                print(error)
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
+            time.sleep(self.frameTime)
+
+    def render(self, lines):
+        changed = [i for i in range(4) if lines[i] != self.shown[i]]
+        if not changed:
+            return
+        # Clear the rows the changed lines cover, then redraw every line that
+        # touches them. Pixels outside those rows are unchanged.
+        top = max(min(self.lineTops[i] for i in changed), 0)
+        bottom = min(max(self.lineTops[i] for i in changed) + self.lineHeight, self.disp.height)
+        self.draw.rectangle((0, top, self.disp.width - 1, bottom - 1), outline=0, fill=0)
+        for i, text in enumerate(lines):
+            if self.lineTops[i] < bottom and self.lineTops[i] + self.lineHeight > top:
+                self.draw.text((0, self.lineTops[i]), text, font=self.font, fill=255)
+        self.shown = lines
+        started = time.perf_counter()
+        sent = writePages(self.disp, self.image, top // 8, (bottom - 1) // 8)
+        metrics.observe("rainbypass_oled_push_seconds", time.perf_counter() - started)
+        metrics.inc("rainbypass_oled_bytes_total", sent)
+        self.bytesSent += sent
+        self.frames += 1
+
+def writePages(disp, image, first, last):
+    # Pack pages first..last of image into the SSD1306 framebuffer and send
+    # only those pages. Returns the number of bytes written to the bus.
+    width = disp.width
+    for page in range(first, last + 1):
+        # Each byte is one column of 8 rows, top row in the low bit
+        band = image.crop((0, page * 8, width, page * 8 + 8))
+        band = band.transpose(Image.FLIP_TOP_BOTTOM).transpose(Image.TRANSPOSE)
+        disp.buffer[1 + page * width:1 + (page + 1) * width] = band.tobytes()
+    try:
+        for cmd in (0x21, 0, width - 1, 0x22, first, last): # Column and page window
+            disp.write_cmd(cmd)
+        with disp.i2c_device:
+            disp.i2c_device.write(b"\x40" + disp.buffer[1 + first * width:1 + (last + 1) * width])
+        return 12 + 1 + (last - first + 1) * width
+    except AttributeError: # Driver without raw access, send everything
+        disp.show()
+        return len(disp.buffer)
+
+scheduler = Scheduler()
+renderer = None       # OLEDRenderer, when a display is attached
+zones = []            # Each zone: one valve, its settings and rolling data
+sites = {}            # Zones sharing a forecast point, keyed by rounded lat/long
+nextValveSlot = 0     # Earliest time the next valve move may start
+forecastCache = None  # ForecastCache of the last response for each site
+countdownEvent = None # Next countdown refresh on the display
+statusSnapshot = b"{}" # JSON status, rebuilt by publishStatus() on the control thread
+controlServer = None  # Unix socket server for status and commands
+sourceTimes = {}      # Each forecast source's recent times to answer, for hedgeDelay()
+sourceWindow = 20     # Answers kept per source
+headless = False      # --headless: no GPIO or display
+
+metrics = Metrics()
+metrics.describe("rainbypass_fetch_seconds", "histogram", "Forecast download time, including the streamed parse.")
+metrics.describe("rainbypass_fetch_bytes_total", "counter", "Forecast response bytes received, before decompression.")
+metrics.describe("rainbypass_fetch_failures_total", "counter", "Forecast fetch attempts that failed, by error.")
+metrics.describe("rainbypass_fetch_breaker_open", "gauge", "1 while fetches for a site are paused after repeated failures.")
+metrics.describe("rainbypass_source_seconds", "histogram", "Time for a forecast source to answer, or fail.")
+metrics.describe("rainbypass_source_wins_total", "counter", "Checks each forecast source supplied the forecast for.")
+metrics.describe("rainbypass_parse_seconds", "histogram", "Time spent parsing forecasts, excluding waits for data.")
+metrics.describe("rainbypass_forecast_cache_total", "counter", "Forecasts served fresh, revalidated, missed or stale from the cache.")
+metrics.describe("rainbypass_decide_seconds", "histogram", "Time to compute a zone's rain totals and decision.")
+metrics.describe("rainbypass_rain_rate", "gauge", "Rain rate of a zone's last decision, in inches per week.")
+metrics.describe("rainbypass_et_rate", "gauge", "Crop evapotranspiration rate of a balance-mode zone's last decision, in inches per week.")
+metrics.describe("rainbypass_watering_disabled", "gauge", "1 while a zone's watering is disabled.")
+metrics.describe("rainbypass_gauge_tips_total", "counter", "Rain gauge tips counted, by pin.")
+metrics.describe("rainbypass_last_check_timestamp_seconds", "gauge", "Unix time of a zone's last check.")
+metrics.describe("rainbypass_valve_move_seconds", "histogram", "Time for a valve to reach position, or to time out.")
+metrics.describe("rainbypass_valve_moves_total", "counter", "Valve moves, by result: moved, timeout, interrupted or error.")
+metrics.describe("rainbypass_oled_push_seconds", "histogram", "Time to send one frame to the display.")
+metrics.describe("rainbypass_oled_bytes_total", "counter", "Bytes sent to the display.")
+metrics.describe("rainbypass_proxy_requests_total", "counter",
+    "Proxy requests, by how they were served: hit, fetched, coalesced, stale or error.")
 
 def runSetup():
     global config
@@ -103,215 +622,1452 @@ def runSetup():
     display[2] = "## Rain Bypass 3.0 ##"
     print(display[2])
 
-    # Setup screen
-    try:
-        i2c = busio.I2C(SCL, SDA)
-        display[0] = adafruit_ssd1306.SSD1306_I2C(128, 32, i2c)
-        display[0].fill(0)
-        display[0].show()
-        
-        display[5] = Image.new('1', (display[0].width, display[0].height))
-        display[6] = ImageDraw.Draw(display[5])
-        display[7] = ImageFont.load_default()
-        print("OLED Display found!")
-    except:
-        display[0] = None
-    
-    # Setup GPIO I/O PIns to output mode
-    try:
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setwarnings(False)
-        GPIO.setup(Pins.OpenRelay, GPIO.OUT)
-        GPIO.setup(Pins.CloseRelay, GPIO.OUT)
-        GPIO.setup(Pins.DataErrLED, GPIO.OUT)
-        GPIO.setup(Pins.EnabledLED, GPIO.OUT)
-        GPIO.setup(Pins.DisabledLED, GPIO.OUT)
-        GPIO.setup(Pins.ClosedSensor, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.setup(Pins.OpenSensor, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-    except:
-        print("GPIO disabled.")
-    
-    # Wait for network to be active, so the clock can be set via NTP
-    isConnected = False
-    while(not isConnected):
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-                s.connect(("pool.ntp.org", 123))
-            isConnected = True
-            display[1] = "IP: %s" % getIP()
-            print(display[1])
-            updateOLED()
-        except:
-            print("Cannot reach pool.ntp.org. Waiting 30 seconds...")
-            display[1] = "Not connected..."
-            updateOLED()
-            time.sleep(30)
-
-    now, waitTime = int(time.time()), 0
-    # Load values from config file, or create it and get values
+    # Load values from config file, or create it and get values. None of
+    # this needs the network.
+    loaded = False
     try: # see if config file exists
         loadConfig()
         PrintConfig()
-        
-        #config["time"] = (now - config["checkIncrement"]) #uncomment for debugging
-        elapsedTime = int(now) - config["time"]
-        waitTime = config["checkIncrement"] - (elapsedTime % config["checkIncrement"])
-        
-        ModifyWatering(config["rainForecasted"])
-        
-        timeLeft = now + waitTime - int(time.time())
-        display[4] = "Waiting %i:%02i mins" % ((timeLeft/60), (timeLeft%60))
-        print(display[4])
+        loaded = True
     except Exception as configError: # Exception: config file does not exist, create new
         print("Error loading value from config file: %s" % configError)
+
+    # Setup screen
+    setupDisplay()
+    if not loaded:
         display[3] = "INVALID CONFIG"
         display[4] = "RUN SETUP"
         updateOLED()
         buildConfig()
         display[3] = ""
         display[4] = ""
-        
-    while int(time.time()) < (now + waitTime):
-        updateOLED()
-        time.sleep(1)
-        timeLeft = now + waitTime - int(time.time())
-        display[4] = "Waiting %i:%02i mins" % ((timeLeft/60), (timeLeft%60))
+    startMetrics()
+    startControl()
+
+    # Setup GPIO I/O PIns to output mode
+    setupGPIO()
+
+    # Valves are set from the saved state before waiting on the network
+    if loaded:
+        restoreDecisions()
+
+    # Wait for network to be active, so the clock can be set via NTP. The
+    # first check starts as soon as it is.
+    waitForNetwork()
     
     display[4] = ""
     updateOLED()
 
+def setupDisplay():
+    # Import the OLED driver and open the screen, unless running headless
+    # or configured without one
+    if headless or not config.get("useOLED", True):
+        return
+    try:
+        from board import SCL, SDA
+        import busio
+        import adafruit_ssd1306
+        setupOLED(adafruit_ssd1306.SSD1306_I2C(128, 32, busio.I2C(SCL, SDA)))
+        print("OLED Display found!")
+    except Exception as error:
+        print(error)
+        display[0] = None
+
+def setupGPIO():
+    # Import RPi.GPIO and set up every zone's pins, unless running headless
+    # or configured without GPIO. Without it valve moves are skipped.
+    global GPIO
+    if headless or not config.get("useGPIO", True):
+        print("GPIO disabled.")
+        return
+    try:
+        import RPi.GPIO as GPIO
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setwarnings(False)
+        GPIO.setup(Pins.DataErrLED, GPIO.OUT)
+        gauges = {} # Zones naming the same gauge pin share its counts
+        for zone in zones:
+            pins = zone["pins"]
+            GPIO.setup(pins.OpenRelay, GPIO.OUT)
+            GPIO.setup(pins.CloseRelay, GPIO.OUT)
+            GPIO.setup(pins.EnabledLED, GPIO.OUT)
+            GPIO.setup(pins.DisabledLED, GPIO.OUT)
+            GPIO.setup(pins.ClosedSensor, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+            GPIO.setup(pins.OpenSensor, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+            for pin in (pins.BypassEnable, pins.BypassDisable):
+                if pin:
+                    GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+                    # Read the switches once the contact has settled after any edge
+                    GPIO.add_event_detect(pin, GPIO.BOTH,
+                        callback=lambda channel, zone=zone: scheduler.after(0.2, bypassChanged, zone))
+            zone["pinOverride"] = readBypass(zone)
+            if pins.RainGauge and pins.RainGauge not in gauges:
+                gauge = gauges[pins.RainGauge] = RainGauge(pins.RainGauge, config["gaugeResolution"],
+                    config["gaugeDebounce"] / 1000)
+                GPIO.setup(pins.RainGauge, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+                GPIO.add_event_detect(pins.RainGauge, GPIO.BOTH, callback=gauge.changed)
+                gauge.start()
+            zone["gauge"] = gauges.get(pins.RainGauge)
+    except Exception as error:
+        print(error)
+        print("GPIO disabled.")
+        GPIO = None
+        for zone in zones:
+            zone["gauge"] = None
+
+def restoreDecisions():
+    # Decide from the saved forecast where it still covers the look-ahead,
+    # otherwise keep the last decision, and move the valves to match. This
+    # runs before NTP has set the clock, so it records nothing: the history
+    # and archive are left to the first check. The current hour counts as
+    # processForecast() would record it.
+    global display
+    hour = currentHour()
+    for zone in zones:
+        qpf, history = zone["qpf"], zone["historicalRain"]
+        if qpf.remaining(hour) >= zone["lookAhead"]:
+            if len(history) and history.newest >= hour:
+                histLen = len(history)
+            elif len(history) and history.newest == hour - 1:
+                histLen = min(len(history) + 1, history.capacity)
+            else: # A gap, so the history would start over
+                histLen = 1
+            lookAhead, aheadHours, behindHours = rainWindows(histLen, qpf.remaining(hour),
+                zone["lookAhead"], zone["lookBehind"])
+            rainRate, rainForecasted = decideRain(qpf.sum(hour + 1, hour + lookAhead + 1), aheadHours,
+                history.sum(hour - behindHours + 1, hour) + toMicro(qpf.at(hour) or 0.0), behindHours,
+                zone["rainfallLimit"])
+            print("%sSaved forecast gives %s in/wk of rain." % (zoneLabel(zone), round(rainRate, 3)))
+            zone["rainForecasted"], zone["rainRate"] = rainForecasted, rainRate
+            if len(zones) <= 1:
+                display[2] = "%.1f in/wk rain fcst" % rainRate
+        queueValveMove(zone, zone["rainForecasted"])
+        
+def waitForNetwork():
+    # Wait for a default route and a name lookup of the forecast server.
+    # Link, address and route changes arrive over netlink and are probed at
+    # once; a jittered probe backing off from 1 to 30 seconds covers systems
+    # without netlink and lookups that fail on their own. The scheduler
+    # keeps running meanwhile, so valve moves still finish.
+    global display
+    
+    wait = {"ready": False, "probing": False, "again": False, "timer": None, "failures": 0}
+    try:
+        watcher = NetworkWatcher(lambda: probeNetwork(wait))
+        watcher.start()
+    except (OSError, AttributeError): # No netlink, probe on the timer alone
+        watcher = None
+    probeNetwork(wait)
+    scheduler.run(done=lambda: wait["ready"])
+    scheduler.cancel(wait["timer"])
+    if watcher:
+        watcher.close()
+    display[1] = "IP: %s" % getIP()
+    print(display[1])
+    updateOLED()
+
+def probeNetwork(wait):
+    # Check readiness on a short-lived thread, as a name lookup can block
+    # for several seconds while DNS is unreachable
+    if wait["ready"]:
+        return
+    if wait["probing"]: # Changed while a probe runs, probe again after it
+        wait["again"] = True
+        return
+    wait["probing"] = True
+    scheduler.cancel(wait["timer"])
+    threading.Thread(target=lambda: scheduler.at(0, networkProbed, wait, networkProblem()), daemon=True).start()
+
+def networkProbed(wait, problem):
+    global display
+    
+    wait["probing"] = False
+    if problem is None:
+        wait["ready"] = True
+        return
+    if wait["again"]:
+        wait["again"] = False
+        probeNetwork(wait)
+        return
+    wait["failures"] += 1
+    delay = backoffDelay(wait["failures"], 1, 30)
+    print("Network not ready (%s). Checking again on a change, or in %.1f second(s)..." % (problem, delay))
+    display[1] = "Not connected..."
+    updateOLED()
+    wait["timer"] = scheduler.after(delay, probeNetwork, wait)
+
+def networkProblem():
+    # None once there is a default route and the forecast server's name
+    # resolves, else what is missing
+    if not hasDefaultRoute():
+        return "no default route"
+    host = urllib.parse.urlsplit(config.get("forecastURL", defaultForecastURL)).hostname
+    try:
+        socket.getaddrinfo(host, None, 0, socket.SOCK_STREAM)
+    except OSError as error:
+        return "cannot resolve %s: %s" % (host, error)
+    return None
+
+def hasDefaultRoute():
+    # An up route to 0.0.0.0/0 in /proc/net/route. Where that cannot be
+    # read, leave it to the name lookup.
+    try:
+        with open("/proc/net/route") as routeFile:
+            for line in routeFile.readlines()[1:]:
+                fields = line.split() # Iface, Destination, Gateway, Flags, ..., Mask
+                if len(fields) > 7 and fields[1] == "00000000" and fields[7] == "00000000" and \
+                        int(fields[3], 16) & 1: # RTF_UP
+                    return True
+    except OSError:
+        return True
+    return False
+
+class NetworkWatcher(threading.Thread):
+    # Listens on a netlink socket for link, IPv4 address and IPv4 route
+    # changes, and calls callback() on the scheduler for each message batch.
+    # Raises OSError, or AttributeError off Linux, where netlink is missing.
+    def __init__(self, callback):
+        threading.Thread.__init__(self, daemon=True)
+        self.callback = callback
+        self.closed = False
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, 0) # NETLINK_ROUTE
+        self.sock.bind((0, 0x1 | 0x10 | 0x40)) # RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE
+
+    def run(self):
+        while not self.closed:
+            try:
+                self.sock.recv(65536)
+            except OSError:
+                if self.closed:
+                    return
+                time.sleep(1) # Receive buffer overran; the probe catches up
+            if not self.closed:
+                scheduler.at(0, self.callback)
+
+    def close(self):
+        # A recv() already waiting returns with the next message, which is
+        # dropped, and the thread ends
+        self.closed = True
+        self.sock.close()
+
 def PrintConfig():
     # Show values/interval used to check weather
-    print("Checking forecast for point: %s, %s" % (config['latValue'], config['longValue']))
-    print("System will look for rain %s hours ahead and %s hours behind the current time."
-        % (config['lookAhead'], config['lookBehind']))
-    print("System will be disabled if rainfall rate over that period is more than")
-    print("    %s inches per week." % config['rainfallLimit'])
+    for zone in zones:
+        if zone["name"]:
+            print("Zone %s:" % zone["name"])
+        print("Checking forecast for point: %s, %s" % (zone['latValue'], zone['longValue']))
+        print("System will look for rain %s hours ahead and %s hours behind the current time."
+            % (zone['lookAhead'], zone['lookBehind']))
+        if zone["decisionMode"] == "balance":
+            print("System will be disabled if rainfall less %s x reference evapotranspiration" %
+                zone["cropCoefficient"])
+            print("    over that period is at least %s inches per week." % zone["balanceLimit"])
+        else:
+            print("System will be disabled if rainfall rate over that period is more than")
+            print("    %s inches per week." % zone['rainfallLimit'])
+        print("Valve has position sensor: %s. Always attempt to move valve: %s." % (zone["valveHasSensor"], zone["forceValve"]) )
+        if zone["pins"].RainGauge:
+            print("Rain gauge on pin %i, %s inches per tip." % (zone["pins"].RainGauge, config["gaugeResolution"]))
     print("System will wait %s seconds (%.1f minute(s) or %.1f hour(s)) between checks." %
         (config['checkIncrement'], (float(config['checkIncrement']) / 60),
         (float(config['checkIncrement']) / 3600)) )
-    print("Valve has position sensor: %s. Always attempt to move valve: %s." % (config["valveHasSensor"], config["forceValve"]) )
+    if len(sites) < len(zones):
+        print("%i zone(s) share %i forecast(s)." % (len(zones), len(sites)))
     
 def CheckWeather():
-    global config
     global display
-    global firstRun
     
     display[4] = "Starting..."
     updateOLED()
     
-    while True: # Loop this forever
-        # wait until next update interval
-        nextUpdate = config["time"] + config["checkIncrement"]
-        if int(time.time()) > nextUpdate: 
-            rainForecasted = False # Does rain exceed limit - Boolean
-            
-            # display[1] = "Last update: " + time.strftime('%H:%M')
-            
-            try:
-                # Fetch XML forecast
-                print("\n# Fetching forecast at %s #" % time.ctime())
-                request = "https://forecast.weather.gov/MapClick.php?lat=" + str(config["latValue"]) + \
-                          "&lon=" + str(config["longValue"]) + "&FcstType=digitalDWML"
-                print("Loading %s ... " % request, end = '')
-                
-                display[4] = "Fetching forecast..."
-                updateOLED()
-
-                with urllib.request.urlopen(request) as response:
-                    responseTree = ET.parse(response)
-                print("Done!")
-
-                # Create array to hold new Quantitative Precipitation Forecast values
-                qpf = []
-
-                # Parse XML into array with only precipitation values (in in/hr)
-                for child in responseTree.getroot().find('.//hourly-qpf'):
-                    qpf.append(float(child.text))
-                    
-
-                print("Calculating rainfall totals...")
-                display[4] = "Calculating..."
-                updateOLED()
-                if len(qpf) >= config["lookAhead"]: # Make sure we actually gathered data
-                    # Process forecast data
-                    rainForecasted = processForecast(qpf)
-                else:
-                    print("Forecast too short.")
-                    display[2] = "Forecast too short"
-                    raise ValueError
+    # Check every site now, as the valves were only set from saved state
+    for site in sites.values():
+        scheduleCheck(site, time.time())
+    scheduler.run() # Loop this forever
 
-                # Cache qpf table as fallback
-                config["qpf"] = qpf
+def scheduleCheck(site, when):
+    # Wait until next update interval, counting down on the display to
+    # whichever site is due first
+    scheduler.cancel(site["checkEvent"])
+    site["checkEvent"] = scheduler.at(when, updateForecast, site)
+    site["due"] = when
+    countdown(min(other["due"] for other in sites.values()), "Next update: %i:%02i")
 
-                # Turn off flashing red data error light if flashing, routine successful
-                try:
-                    GPIO.output(Pins.DataErrLED, False)
-                except Exception as error:
-                    print(error)
-                    
-                display[1] = "IP: %s" % getIP()
-                updateOLED()
-                
-            except Exception as dataError: # Data unavailable - either connection error, or network error
-                try:
-                    GPIO.output(Pins.DataErrLED, True) # Turn on flashing red data error light
-                except Exception as error:
-                    print(error)
-
-                print("Error contacting weather.gov. %s" % dataError)
-                if len(config["qpf"])>config["lookAhead"]:
-                    print(" Using cached forecast data.")
-                    display[2] = "Using cached data"
-                    # Remove first entry in cached qpf table, since we won't be fetching a new one
-                    del config["qpf"][:1] 
-                    # Process forecast data
-                    rainForecasted = processForecast(config["qpf"])
-                else:
-                    print(" Insufficient cached data.")
-                    display[2] = "Insufficient cache"
-                    display[4] = ""
-                    config["historicalRain"] = [] # Clearing historical data, since it is now inaccurate
-                    config["time"] = int(time.time()) - config["checkIncrement"] + 60
+def countdown(deadline, label):
+    global display
+    global countdownEvent
+    
+    scheduler.cancel(countdownEvent)
+    timeLeft = max(math.ceil(deadline - time.time()), 0)
+    if not any(zone["valveMove"] for zone in zones): # Leave valve progress on screen while it moves
+        display[4] = label % ((timeLeft/60), (timeLeft%60))
+        updateOLED()
+    if timeLeft > 0:
+        # Wake again on the next multiple of displayRefresh seconds left
+        step = config.get("displayRefresh", 60)
+        countdownEvent = scheduler.at(deadline - ((timeLeft - 1) // step) * step, countdown, deadline, label)
 
-            # Now that we know current conditions and forecast, modify watering schedule
-            
-            if rainForecasted != config["rainForecasted"]:
-                config["rainForecasted"] = rainForecasted
-                ModifyWatering(config["rainForecasted"])
-            elif config["valveHasSensor"] or config["forceValve"] or firstRun:
-                # Always try to move the valve if it has a sensor, force option is enabled, or first run
-                ModifyWatering(config["rainForecasted"])
+def updateForecast(site):
+    scheduler.cancel(countdownEvent)
+    site["due"] = math.inf
+    print("\nIdle since last check: %i wakeup(s), %.3f%% CPU" % scheduler.stats())
+    print("Forecast cache: %(fresh)i fresh, %(revalidated)i revalidated, %(miss)i miss(es), %(stale)i stale" %
+        forecastCache.stats)
+    print("\n# Fetching forecast at %s #" % time.ctime())
+    # The download runs on the site's fetcher thread. Until it finishes, or
+    # the fetchDeadline passes, its valves stay on the last decision and the
+    # scheduler keeps serving the display, valve events and other sites.
+    site["tick"] = {"deadline": time.time() + config["fetchDeadline"], "attempts": {}, "timer": None, "hedge": None}
+    # Should this check fail with an error before it schedules the next
+    # one, the site is checked again an increment after the deadline
+    site["checkEvent"] = scheduler.at(site["tick"]["deadline"] + config["checkIncrement"], updateForecast, site)
+    publishStatus()
+    startFetch(site)
+
+def startFetch(site):
+    global display
+    
+    tick, breaker = site["tick"], site["breaker"]
+    if time.time() < breaker["openUntil"]:
+        print("Forecast source failing, skipping fetch for %i more second(s)." %
+            (breaker["openUntil"] - time.time()))
+        decideForecast(site, None, ConnectionError("circuit breaker open"))
+        return
+    
+    urls = tick["urls"] = [url % (site["latValue"], site["longValue"]) for url in forecastSources()]
+    entry = forecastCache.get(site["key"])
+    if entry and entry["url"] not in urls: # Cached for other settings
+        entry = None
+    if entry and entry["expires"] > time.time() and entry["hour"] + len(entry["qpf"]) - currentHour() >= \
+            max(zone["lookAhead"] for zone in site["zones"]):
+        print("Cached forecast is fresh for %i more second(s)." % (entry["expires"] - time.time()))
+        forecastCache.stats["fresh"] += 1
+        decideForecast(site, (entry["qpf"], entry["hour"], entry.get("columns", {})), None)
+        return
+    display[4] = "Fetching forecast..."
+    updateOLED()
+    
+    tick.update(attempts={}, next=0, entry=entry)
+    hedgeFetch(site)
+    # Hard limit on the whole attempt, however slowly the data trickles in
+    tick["timer"] = scheduler.at(min(time.time() + config["fetchTimeout"], tick["deadline"]),
+        fetchDone, site, None, None, TimeoutError("no forecast within %i seconds" % config["fetchTimeout"]))
+
+def forecastSources():
+    # forecastURL first, then the sources tried alongside it when it is slow
+    return [config["forecastURL"]] + config.get("hedgeURLs", [])
+
+def hedgeFetch(site):
+    # Start the site's next forecast source, on its own fetcher. If it has
+    # not answered within its usual time, the one after it starts too; the
+    # first usable forecast wins.
+    tick = site["tick"]
+    scheduler.cancel(tick["hedge"])
+    source = tick["next"]
+    tick["next"] += 1
+    url, entry = tick["urls"][source], tick["entry"]
+    print("%s %s ..." % ("Also trying" if source else "Loading", url))
+    attempt = object()
+    tick["attempts"][attempt] = (source, time.time())
+    site["fetchers"][source].submit(url, config["fetchTimeout"],
+        lambda result, error: fetchDone(site, attempt, result, error), entry if entry and entry["url"] == url else None)
+    tick["hedge"] = scheduler.after(hedgeDelay(url), hedgeFetch, site) if tick["next"] < len(tick["urls"]) else None
+
+def hedgeDelay(url):
+    # The p95 of the source's last sourceWindow times to answer, once it
+    # has ten, or else hedgeDelay; at least half a second and at most
+    # fetchTimeout. A slow spell ages out of the window.
+    times = sorted(sourceTimes.get(sourceLabel(url), ()))
+    p95 = times[math.ceil(0.95 * len(times)) - 1] if len(times) >= 10 else config.get("hedgeDelay", 5)
+    return min(max(p95, 0.5), config["fetchTimeout"])
+
+def sourceLabel(url):
+    return urllib.parse.urlsplit(url).netloc
+
+def recordSourceTime(url, started):
+    # Time a source took to answer, for its hedge delay and the metrics.
+    # An attempt cut off before it answered records the time it had run,
+    # a lower bound, so a source that is always overtaken still looks slow.
+    seconds = time.time() - started
+    metrics.observe("rainbypass_source_seconds", seconds, source=sourceLabel(url))
+    sourceTimes.setdefault(sourceLabel(url), deque(maxlen=sourceWindow)).append(seconds)
+
+def fetchDone(site, attempt, result, error):
+    global display
+    
+    # attempt is None when the time for the whole check has run out
+    tick, breaker = site["tick"], site["breaker"]
+    if not tick or (attempt is not None and attempt not in tick["attempts"]): # Superseded or timed out
+        return
+    if attempt is not None:
+        source, started = tick["attempts"].pop(attempt)
+        url = tick["urls"][source]
+        recordSourceTime(url, started)
+    
+    if error is None:
+        qpf, qpfTimes, headers, columns = result
+        modified = qpf is not None
+        if not modified: # Nothing to parse
+            entry = forecastCache.revalidated(site["key"], headers)
+            if entry:
+                print("Forecast not modified.")
+                forecastCache.stats["revalidated"] += 1
+                qpf, qpfHour, columns = entry["qpf"], entry["hour"], entry.get("columns", {})
             else:
-                if rainForecasted:
-                    display[3] = "Watering DISABLED"
-                else:
-                    display[3] = "Watering ENABLED"
-                print(display[3])
+                error = ValueError("not modified, but no longer cached")
+        else:
+            forecastCache.stats["miss"] += 1
+            qpf, qpfHour = placeForecast(qpf, qpfTimes, columns)
+    if error is None:
+        # Make sure we actually gathered data, from the current hour on
+        if qpfHour + len(qpf) - currentHour() < max(zone["lookAhead"] for zone in site["zones"]):
+            print("Forecast too short.")
+            display[2] = "Forecast too short"
+            error = ValueError("forecast too short")
+    if error is not None and attempt is not None and (tick["attempts"] or tick["next"] < len(tick["urls"])):
+        # Another source is running or still to try; start the next one
+        # now rather than waiting for the hedge
+        print("Fetch from %s failed (%s)." % (sourceLabel(url), error))
+        metrics.inc("rainbypass_fetch_failures_total", error=type(error).__name__)
+        if tick["next"] < len(tick["urls"]):
+            hedgeFetch(site)
+        return
+    # Done with this try: the first usable forecast wins, and any source
+    # still running is cut off
+    scheduler.cancel(tick["timer"])
+    scheduler.cancel(tick["hedge"])
+    tick["hedge"] = None
+    for other, started in tick["attempts"].values():
+        site["fetchers"][other].abort()
+        recordSourceTime(tick["urls"][other], started)
+    tick["attempts"].clear()
+    if error is None:
+        if modified:
+            forecastCache.store(site["key"], url, qpf, qpfHour, headers, columns)
+        metrics.inc("rainbypass_source_wins_total", source=sourceLabel(url))
+        breaker["failures"] = 0
+        site["lastFetch"] = int(time.time())
+        print("Done!")
+        if qpfTimes:
+            print("Forecast starts %s" % qpfTimes[0])
+        decideForecast(site, (qpf, qpfHour, columns), None)
+        return
+    
+    # Back off before retrying, giving up for this check at fetchDeadline,
+    # and stop trying altogether for a while after repeated failures
+    metrics.inc("rainbypass_fetch_failures_total", error=type(error).__name__)
+    breaker["failures"] += 1
+    if breaker["failures"] >= config["breakerThreshold"]:
+        breaker["openUntil"] = time.time() + config["breakerCooldown"]
+    delay = backoffDelay(breaker["failures"], 5, 60)
+    if time.time() + delay < tick["deadline"] and time.time() >= breaker["openUntil"]:
+        print("Fetch failed (%s). Retrying in %.0f seconds." % (error, delay))
+        display[4] = "Fetch failed, retrying"
+        updateOLED()
+        tick["timer"] = scheduler.after(delay, startFetch, site)
+    else:
+        decideForecast(site, None, error)
 
-            # Store values in config file
-            config["time"] = int(time.time()) # Update timestamp
-            with open(getCfgFile(),"w") as configFile:
-                json.dump(config, configFile)
+def backoffDelay(failures, base, cap):
+    # Exponential backoff with jitter, so a fleet of controllers that failed
+    # together does not retry together
+    return min(cap, base * 2 ** (failures - 1)) * random.uniform(0.5, 1.0)
+
+def decideForecast(site, forecast, dataError):
+    # Make this check's decision for every zone of the site, from the new
+    # forecast (its values, the hour of the first and the other series'
+    # columns) or else the cache
+    global config
+    global display
+    
+    site["tick"] = None
+    decisions = [] # (zone, rain exceeds limit) for each zone with enough data
+    retryTime = None # Check sooner than the next increment
+    hour = currentHour()
+    
+    # Hours since each zone's last check go into its history from the
+    # forecast that covered them, before that forecast is replaced
+    snapshot = [zone for zone in site["zones"] if fillHistory(zone, site["qpf"], hour) != 0]
+    
+    # display[1] = "Last update: " + time.strftime('%H:%M')
+    
+    if dataError is None:
+        print("Calculating rainfall totals...")
+        display[4] = "Calculating..."
+        updateOLED()
+        qpf, qpfHour, columns = forecast
+        site["qpf"].load(qpf, qpfHour)
+        et = siteET(site, columns, qpfHour)
+        # Process forecast data
+        decisions = [(zone, processForecast(zone, site["qpf"], hour, et)) for zone in site["zones"]]
+
+        # Turn off flashing red data error light if flashing, routine successful
+        site["dataError"] = False
+        setDataErrLED()
             
-            print("Checking forecast again in %i minute(s)" %
-                (config["checkIncrement"] / 60))
-        else: # Things to do while waiting
-            timeLeft = nextUpdate - int(time.time())
-            display[4] = "Next update: %i:%02i" % ((timeLeft/60), (timeLeft%60))
-            time.sleep(1)
-
-        # Update display
+        display[1] = "IP: %s" % getIP()
         updateOLED()
+        
+    else: # Data unavailable - either connection error, or network error
+        site["dataError"] = True
+        setDataErrLED() # Turn on flashing red data error light
+
+        print("Error contacting weather.gov. %s" % dataError)
+        # Fall back on the last response, from the current hour on, or
+        # without one on the forecast held from the last check
+        entry = forecastCache.get(site["key"])
+        stale = RainForecast(entry["qpf"], entry["hour"]) if entry else site["qpf"]
+        cached = [zone for zone in site["zones"] if stale.remaining(hour) >= zone["lookAhead"]]
+        if cached:
+            print(" Using cached forecast data.")
+            display[2] = "Using cached data"
+            forecastCache.stats["stale"] += 1
+            if entry:
+                site["qpf"].load(entry["qpf"], entry["hour"])
+                et = siteET(site, entry.get("columns", {}), entry["hour"])
+            else:
+                if site["qpf"].first < hour: # Drop the hours already past
+                    site["qpf"].load(site["qpf"].series(hour), hour)
+                et = siteET(site, {}, hour)
+            # Process forecast data
+            decisions = [(zone, processForecast(zone, site["qpf"], hour, et)) for zone in cached]
+        if len(cached) < len(site["zones"]):
+            print(" Insufficient cached data.")
+            display[2] = "Insufficient cache"
+            display[4] = ""
+            for zone in site["zones"]:
+                if zone not in cached:
+                    # Clearing historical data, since it is now inaccurate
+                    zone["historicalRain"].clear()
+                    decisions.append((zone, None))
+            breaker = site["breaker"]
+            retryTime = int(time.time() + max(backoffDelay(breaker["failures"], 60, config["checkIncrement"]),
+                breaker["openUntil"] - time.time()))
+
+    # Now that we know current conditions and forecast, modify watering schedule
+    
+    now = int(time.time())
+    for zone, rainForecasted in decisions:
+        historyCleared = rainForecasted is None
+        rainForecasted = bool(rainForecasted) # Water when there is no data
+        if rainForecasted != zone["rainForecasted"]:
+            zone["rainForecasted"] = rainForecasted
+            queueValveMove(zone, zone["rainForecasted"])
+        elif zone["valveHasSensor"] or zone["forceValve"] or zone["firstRun"]:
+            # Always try to move the valve if it has a sensor, force option is enabled, or first run
+            queueValveMove(zone, zone["rainForecasted"])
+        else:
+            print("%sWatering %s" % (zoneLabel(zone), "DISABLED" if rainForecasted else "ENABLED"))
 
-def getCfgFile():
-    cfgName = "rain-bypass-3.cfg"
+        # Journal this check. A record holds the current hour of history,
+        # and with a gauge the hour before, so a check that filled in missed
+        # hours, or measured ones before those, writes a snapshot instead.
+        zone["time"] = now # Update timestamp
+        metrics.set("rainbypass_watering_disabled", int(rainForecasted), zone=zone["name"])
+        metrics.set("rainbypass_last_check_timestamp_seconds", now, zone=zone["name"])
+        remeasured, zone["remeasured"] = zone["remeasured"], False
+        if (zone in snapshot or remeasured) and not historyCleared:
+            saveState(zone)
+        else:
+            appendState(zone, historyCleared)
+    site["time"] = now
+    showZones()
+    
+    if retryTime:
+        print("Checking forecast again in %i second(s)" % (retryTime - time.time()))
+        scheduleCheck(site, retryTime)
+    else:
+        print("Checking forecast again in %i minute(s)" %
+            (config["checkIncrement"] / 60))
+        scheduleCheck(site, site["time"] + config["checkIncrement"])
+    publishStatus()
+
+def setDataErrLED():
+    # Lit while any site is running without fresh data
+    if GPIO is None:
+        return
+    try:
+        GPIO.output(Pins.DataErrLED, any(site["dataError"] for site in sites.values()))
+    except Exception as error:
+        print(error)
+
+def zoneLabel(zone):
+    # Prefix for zone messages; the single unnamed zone gets none
+    return "[%s] " % zone["name"] if zone["name"] else ""
+
+def showZones():
+    # Line 3 shows the watering state; with several zones, lines 2 and 3
+    # summarize them all
+    global display
+    if len(zones) == 1:
+        display[3] = "Watering %s%s" % ("DISABLED" if wateringDisabled(zones[0]) else "ENABLED",
+            " (forced)" if overrideOf(zones[0]) else "")
+    elif zones:
+        rates = [zone["rainRate"] for zone in zones if zone["rainRate"] is not None]
+        if rates:
+            display[2] = "%.1f-%.1f in/wk rain" % (min(rates), max(rates))
+        display[3] = "Watering %i/%i zones" % (sum(not wateringDisabled(zone) for zone in zones), len(zones))
+    updateOLED()
+
+def publishStatus():
+    # Rebuild the status snapshot whenever something it shows changes.
+    # Other threads only ever take the finished bytes, so serving status
+    # never waits on, or runs code in, the control loop.
+    global statusSnapshot
+    statusSnapshot = json.dumps({"time": int(time.time()),
+        "zones": [{"name": zone["name"], "rainRate": zone["rainRate"], "netRate": zone["netRate"],
+            "rainForecasted": zone["rainForecasted"] if "time" in zone else None,
+            "wateringDisabled": wateringDisabled(zone) if "time" in zone else None,
+            "override": overrideOf(zone), "overrideSource": "switch" if zone["pinOverride"] else
+                "command" if zone["override"] else None,
+            "overrideUntil": zone["override"]["until"] if zone["override"] and not zone["pinOverride"] else None,
+            "valve": zone["valve"], "lastCheck": zone.get("time")} for zone in zones],
+        "sites": [{"latitude": site["latValue"], "longitude": site["longValue"],
+            "zones": [zone["name"] for zone in site["zones"]], "lastCheck": site["time"],
+            "lastFetch": site["lastFetch"], "fetching": site["tick"] is not None,
+            "nextCheck": site["due"] if site["due"] < math.inf else None, "dataError": site["dataError"],
+            "fetchFailures": site["breaker"]["failures"],
+            "breakerOpenUntil": site["breaker"]["openUntil"] or None} for site in sites.values()]}).encode()
+
+class ForecastFetcher(threading.Thread):
+    # Downloads forecasts off the control thread, keeping a keep-alive
+    # connection per server between attempts. Each result is handed back
+    # through the scheduler as callback(result, error).
+    def __init__(self):
+        threading.Thread.__init__(self, daemon=True)
+        self.jobs = queue.Queue()
+        self.connections = {}
+        self.links = {}    # api.weather.gov points URL -> its forecastGridData URL
+        self.active = None # Connection in use, so abort() can cut it off
+
+    def submit(self, url, timeout, callback, validators=None):
+        if not self.is_alive():
+            self.start()
+        self.jobs.put((url, timeout, callback, validators))
+
+    def abort(self):
+        connection = self.active
+        if connection and connection.sock:
+            try:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def run(self):
+        while True:
+            url, timeout, callback, validators = self.jobs.get()
+            columns = {}
+            try:
+                result, error = fetchForecast(url, timeout, self, validators, columns) + (columns,), None
+            except Exception as fetchError:
+                result, error = None, fetchError
+            scheduler.at(0, callback, result, error)
+
+class MeteredStream:
+    # Counts the bytes read from a response and the time spent waiting for
+    # them, so parsing time can be told apart from network time
+    def __init__(self, stream):
+        self.stream, self.bytes, self.waited = stream, 0, 0.0
+
+    def read(self, size=None):
+        started = time.perf_counter()
+        data = self.stream.read(size)
+        self.waited += time.perf_counter() - started
+        self.bytes += len(data)
+        return data
+
+def fetchForecast(url, timeout=None, fetcher=None, validators=None, columns=None):
+    # Ask for a compressed response and stream-parse it as it arrives.
+    # With a fetcher, its open connection to the server is reused. With
+    # validators (a cache entry's etag and lastModified) the request is
+    # conditional. With columns (a dict), the other hourly series are
+    # parsed into it too. Returns the qpf values, their start times and
+    # the response headers; qpf is None when the server answered 304.
+    # Takes DWML, forecast proxy and api.weather.gov gridpoint responses;
+    # an api.weather.gov points lookup is followed to the gridpoint data.
+    if fetcher and url in fetcher.links: # Looked up before
+        return fetchForecast(fetcher.links[url], timeout, fetcher, validators, columns)
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path + ("?" + parts.query if parts.query else "")
+    connections = fetcher.connections if fetcher else {}
+    headers = {"Accept-Encoding": "gzip", "User-Agent": "rain-bypass/3.0"} # api.weather.gov needs an agent
+    if validators and validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators and validators.get("lastModified"):
+        headers["If-Modified-Since"] = validators["lastModified"]
+    for reused in (True, False):
+        connection = connections.pop(parts.netloc, None) if reused else None
+        if reused and connection is None:
+            continue
+        if connection is None:
+            connectionType = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+            connection = connectionType(parts.netloc, timeout=timeout)
+        connection.timeout = timeout
+        if connection.sock:
+            connection.sock.settimeout(timeout)
+        if fetcher:
+            fetcher.active = connection
+        started = time.perf_counter()
+        try:
+            connection.request("GET", path, headers=headers)
+            response = connection.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            connection.close()
+            if reused: # Server closed the idle connection, open a new one
+                continue
+            raise
+        except Exception:
+            connection.close()
+            raise
+        stream, received = MeteredStream(response), time.perf_counter()
+        link = None
+        try:
+            if response.status == 304 and validators:
+                result = None, []
+            elif response.status != 200:
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+            elif response.getheader("Content-Type", "").startswith(qpfContentType): # From a forecast proxy
+                qpf, hour = unpackForecast(stream.read())
+                result = qpf, [datetime.fromtimestamp((hour + i) * 3600, timezone.utc).isoformat()
+                    for i in range(len(qpf))]
+            elif response.getheader("Content-Type", "").startswith(("application/geo+json", "application/json")):
+                body = gzip.GzipFile(fileobj=stream) \
+                    if response.getheader("Content-Encoding", "").lower() == "gzip" else stream
+                properties = json.load(body).get("properties") or {}
+                if "quantitativePrecipitation" not in properties and properties.get("forecastGridData"):
+                    link, result = properties["forecastGridData"], (None, []) # A points lookup
+                else:
+                    result = parseGridpoints(properties, columns)
+            elif response.getheader("Content-Encoding", "").lower() == "gzip":
+                result = parseForecast(gzip.GzipFile(fileobj=stream), columns)
+            else:
+                result = parseForecast(stream, columns)
+            if result[0] is not None:
+                metrics.observe("rainbypass_parse_seconds", time.perf_counter() - received - stream.waited)
+            stream.read() # Drain the rest so the connection can be reused
+        except Exception:
+            connection.close()
+            raise
+        finally:
+            if fetcher:
+                fetcher.active = None
+            metrics.inc("rainbypass_fetch_bytes_total", stream.bytes)
+        metrics.observe("rainbypass_fetch_seconds", time.perf_counter() - started)
+        if response.will_close:
+            connection.close()
+        else:
+            connections[parts.netloc] = connection
+        if link:
+            if fetcher:
+                fetcher.links[url] = link
+            return fetchForecast(link, timeout, fetcher, validators, columns)
+        return result + (response.headers,)
+
+# DWML series parsed into columns next to hourly-qpf, by element and type
+forecastColumns = {("temperature", "hourly"): "temperature", ("temperature", "dew point"): "dewPoint",
+    ("temperature", "heat index"): "heatIndex", ("humidity", "relative"): "humidity",
+    ("wind-speed", "sustained"): "windSpeed", ("wind-speed", "gust"): "windGust",
+    ("direction", "wind"): "windDirection", ("cloud-amount", "total"): "cloudCover",
+    ("probability-of-precipitation", "floating"): "pop"}
+
+def columnValue(text):
+    # Missing (xsi:nil) or unreadable values are NaN
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return math.nan
+
+def parseForecast(stream, columns=None):
+    # Walk the DWML document once, keeping the time layouts, the hourly-qpf
+    # series and, given a columns dict, the forecastColumns series. Each
+    # block is cleared as soon as it closes and reading stops once every
+    # series wanted has been seen, so the full tree is never built. Returns
+    # the qpf values (in in/hr) and their start-valid-times; each column is
+    # lined up with them, NaN where its layout has no value for an hour.
+    layouts, found = {}, {}
+    layoutKey, times, qpf = None, [], None
+    for event, elem in ET.iterparse(stream):
+        if elem.tag == "value" or elem.tag == "end-valid-time":
+            continue # cleared with their parent
+        elif elem.tag == "start-valid-time":
+            times.append(elem.text)
+            continue
+        elif elem.tag == "layout-key":
+            layoutKey = (elem.text or "").strip()
+        elif elem.tag == "time-layout":
+            layouts[layoutKey] = times
+            layoutKey, times = None, []
+        elif elem.tag == "hourly-qpf":
+            qpf = [float(child.text) for child in elem]
+            qpfLayout = elem.get("time-layout")
+        elif columns is not None and (elem.tag, elem.get("type")) in forecastColumns:
+            found[forecastColumns[elem.tag, elem.get("type")]] = (elem.get("time-layout"),
+                [columnValue(child.text) for child in elem if child.tag == "value"])
+        elif elem.tag == "parameters" and qpf is not None:
+            break
+        elem.clear()
+        if qpf is not None and (columns is None or len(found) == len(forecastColumns)):
+            break
+
+    if qpf is None:
+        raise ValueError("No hourly-qpf in forecast")
+    qpfTimes = layouts.get(qpfLayout, [])
+    for name, (layout, values) in found.items():
+        if layout != qpfLayout: # Line up by start time
+            byTime = dict(zip(layouts.get(layout, []), values))
+            values = [byTime.get(start, math.nan) for start in qpfTimes]
+        columns[name] = (values + [math.nan] * len(qpf))[:len(qpf)]
+    return qpf, qpfTimes
+
+# api.weather.gov gridpoint series parsed into the same columns as DWML
+gridColumns = {"temperature": "temperature", "dewpoint": "dewPoint", "heatIndex": "heatIndex",
+    "relativeHumidity": "humidity", "windSpeed": "windSpeed", "windGust": "windGust",
+    "windDirection": "windDirection", "skyCover": "cloudCover", "probabilityOfPrecipitation": "pop"}
+gridUnits = {"wmoUnit:mm": (1 / 25.4, 0), "wmoUnit:degC": (1.8, 32), # to inches, Fahrenheit
+    "wmoUnit:km_h-1": (0.621371, 0), "wmoUnit:m_s-1": (2.23694, 0)}  # and miles/hour, as DWML
+isoDuration = re.compile(r"P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:\d+M)?)?")
+
+def gridHours(series, spread=False):
+    # A gridpoint series as {absolute hour: value} in DWML units. Each value
+    # holds for an ISO 8601 interval, "start/PT6H"; with spread, an amount
+    # is divided among the interval's hours instead.
+    scale, offset = gridUnits.get(series.get("uom"), (1, 0))
+    hours = {}
+    for item in series.get("values", []):
+        start, _, duration = item["validTime"].partition("/")
+        first = int(datetime.fromisoformat(start).timestamp() // 3600)
+        match = isoDuration.fullmatch(duration)
+        length = max(24 * int(match.group(1) or 0) + int(match.group(2) or 0), 1) if match else 1
+        value = math.nan if item["value"] is None else item["value"] * scale + offset
+        for hour in range(first, first + length):
+            hours[hour] = value / length if spread else value
+    return hours
+
+def parseGridpoints(properties, columns=None):
+    # The quantitativePrecipitation series of api.weather.gov gridpoint
+    # data, made hourly like DWML: returns qpf (in/hr, 0.0 where missing)
+    # and each hour's start time, with columns filled as parseForecast does
+    qpfHours = gridHours(properties.get("quantitativePrecipitation") or {}, spread=True)
+    if not qpfHours:
+        raise ValueError("No quantitativePrecipitation in forecast")
+    hours = range(min(qpfHours), max(qpfHours) + 1)
+    qpf = [0.0 if math.isnan(qpfHours.get(hour, math.nan)) else qpfHours[hour] for hour in hours]
+    if columns is not None:
+        for key, name in gridColumns.items():
+            if properties.get(key):
+                values = gridHours(properties[key])
+                columns[name] = [values.get(hour, math.nan) for hour in hours]
+    return qpf, [datetime.fromtimestamp(hour * 3600, timezone.utc).isoformat() for hour in hours]
+
+class ForecastCache:
+    # Parsed forecast responses on disk, one JSON file per forecast point.
+    # The validators and freshness lifetime the server sent change on every
+    # check, so they are kept apart, all points in one small file, and a
+    # point's own file is only rewritten when the forecast in it changes.
+    # Files are evicted least recently used first to stay under maxBytes.
+    validatorKeys = ("expires", "etag", "lastModified")
+
+    def __init__(self, directory, maxBytes=1048576):
+        self.directory, self.maxBytes = directory, maxBytes
+        self.entries, self.sizes, self.used, self.digests = {}, {}, {}, {}
+        self.stats = {"fresh": 0, "revalidated": 0, "miss": 0, "stale": 0}
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith(".json"):
+                path = os.path.join(directory, name)
+                self.sizes[name], self.used[name] = os.path.getsize(path), os.path.getmtime(path)
+        try:
+            with open(os.path.join(directory, "validators")) as validatorsFile:
+                self.validators = json.load(validatorsFile)
+        except (OSError, ValueError):
+            self.validators = {}
+
+    def fileName(self, key):
+        return "%+.2f%+.2f.json" % key
+
+    def get(self, key):
+        name = self.fileName(key)
+        if name not in self.entries and name in self.sizes:
+            try:
+                with open(os.path.join(self.directory, name), "rb") as entryFile:
+                    data = entryFile.read()
+                entry = json.loads(data)
+                # Files written before the validators were split out hold their own
+                entry.update(self.validators.get(name, {}))
+                for field in self.validatorKeys:
+                    entry.setdefault(field, 0 if field == "expires" else None)
+                self.entries[name], self.digests[name] = entry, zlib.crc32(data)
+            except (OSError, ValueError): # Unreadable, drop it
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(self.directory, name))
+                self.sizes.pop(name)
+                self.used.pop(name, None)
+        if name in self.entries:
+            self.used[name] = time.time()
+        return self.entries.get(name)
+
+    def put(self, key, entry):
+        name = self.fileName(key)
+        data = json.dumps({field: value for field, value in entry.items() if field not in self.validatorKeys}).encode()
+        if name not in self.sizes or self.digests.get(name) != zlib.crc32(data):
+            writeAtomic(os.path.join(self.directory, name), data)
+            self.sizes[name], self.digests[name] = len(data), zlib.crc32(data)
+        self.entries[name], self.used[name] = entry, time.time()
+        total = sum(self.sizes.values())
+        for oldest in sorted(self.used, key=self.used.get):
+            if total <= self.maxBytes:
+                break
+            if oldest != name:
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(self.directory, oldest))
+                total -= self.sizes.pop(oldest, 0)
+                for held in (self.entries, self.digests, self.validators):
+                    held.pop(oldest, None)
+                self.used.pop(oldest)
+        self.saveValidators(name, entry)
+
+    def saveValidators(self, name, entry):
+        # Rewrite the validators file, a few hundred bytes. Losing it to a
+        # power cut costs one unconditional download, so it is not synced.
+        self.validators[name] = {key: entry[key] for key in self.validatorKeys}
+        path = os.path.join(self.directory, "validators")
+        with contextlib.suppress(OSError):
+            with open(path + ".tmp", "w") as validatorsFile:
+                json.dump(self.validators, validatorsFile)
+            os.replace(path + ".tmp", path)
+
+    def store(self, key, url, qpf, hour, headers, columns=None):
+        # Cache a full response, unless the server forbids it. hour is the
+        # absolute hour of qpf[0], and of the first value of each column.
+        lifetime = cacheLifetime(headers)
+        if lifetime is not None:
+            self.put(key, {"url": url, "qpf": qpf, "hour": hour, "columns": columns or {},
+                "expires": time.time() + lifetime, "etag": headers.get("ETag"),
+                "lastModified": headers.get("Last-Modified")})
+
+    def revalidated(self, key, headers):
+        # Refresh an entry after a 304; returns it, or None if it was
+        # evicted. The forecast itself is unchanged, so only the validators
+        # file is written.
+        entry = self.get(key)
+        if entry:
+            entry["expires"] = time.time() + (cacheLifetime(headers) or 0)
+            entry["etag"] = headers.get("ETag", entry["etag"])
+            entry["lastModified"] = headers.get("Last-Modified", entry["lastModified"])
+            self.saveValidators(self.fileName(key), entry)
+        return entry
+
+def cacheLifetime(headers):
+    # Seconds a response may be used without revalidating, from its
+    # Cache-Control or Expires header, or None if it must not be stored
+    control = {}
+    for directive in headers.get("Cache-Control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        control[name.lower()] = value.strip('"')
+    if "no-store" in control:
+        return None
+    try:
+        if "no-cache" in control:
+            return 0
+        if "max-age" in control:
+            return max(int(control["max-age"]) - int(headers.get("Age", 0)), 0)
+        if headers.get("Expires"):
+            date = headers.get("Date")
+            now = email.utils.parsedate_to_datetime(date).timestamp() if date else time.time()
+            return max(email.utils.parsedate_to_datetime(headers["Expires"]).timestamp() - now, 0)
+    except (ValueError, TypeError): # Malformed header, revalidate every time
+        pass
+    return 0
+
+def placeForecast(qpf, qpfTimes, columns=None):
+    # Line the qpf values up with their start-valid-times. Returns the
+    # values, one per hour with any gaps filled with 0.0, and the absolute
+    # hour of the first. Without usable times qpf[0] is the current hour.
+    # Any columns are lined up the same way, in place, with NaN in gaps.
+    try:
+        hours = [int(datetime.fromisoformat(start).timestamp() // 3600) for start in qpfTimes]
+    except (TypeError, ValueError):
+        hours = []
+    if not qpf or len(hours) != len(qpf) or any(b <= a for a, b in zip(hours, hours[1:])):
+        return qpf, currentHour()
+    if hours[-1] - hours[0] + 1 == len(qpf):
+        return qpf, hours[0]
+    values = [0.0] * (hours[-1] - hours[0] + 1)
+    for hour, value in zip(hours, qpf):
+        values[hour - hours[0]] = value
+    for name, column in (columns or {}).items():
+        columns[name] = [math.nan] * len(values)
+        for hour, value in zip(hours, column):
+            columns[name][hour - hours[0]] = value
+    return values, hours[0]
+
+# Forecast proxy responses: this header, then one little-endian int32 of
+# micro-inches per hour, whatever the byte order of either host
+qpfHeader = struct.Struct("<4sqH") # magic, hour of the first value, count
+qpfContentType = "application/x-rain-bypass-qpf"
+
+def packForecast(qpf, hour):
+    return qpfHeader.pack(b"RBQ1", hour, len(qpf)) + struct.pack("<%ii" % len(qpf), *map(toMicro, qpf))
+
+def unpackForecast(data):
+    # Returns the qpf values (in/hr) and the hour of the first
+    if len(data) < qpfHeader.size:
+        raise ValueError("Truncated forecast")
+    magic, hour, count = qpfHeader.unpack_from(data)
+    if magic != b"RBQ1" or len(data) != qpfHeader.size + 4 * count:
+        raise ValueError("Malformed forecast")
+    return [value / 1000000 for value in struct.unpack_from("<%ii" % count, data, qpfHeader.size)], hour
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] == "/status": # Read-only; commands go through the control socket
+            body, contentType = statusSnapshot, "application/json"
+        elif self.path.split("?")[0] in ("/", "/metrics"):
+            body, contentType = metrics.render().encode(), "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def startMetrics():
+    # Serve /metrics on its own thread, if a port is configured
+    if not config.get("metricsPort"):
+        return
+    try:
+        server = http.server.ThreadingHTTPServer(("", config["metricsPort"]), MetricsHandler)
+    except OSError as error:
+        print("Metrics endpoint unavailable: %s" % error)
+        return
+    server.daemon_threads = True
+    metrics.collectors.append(collectMetrics)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("Serving metrics on port %i" % config["metricsPort"])
+
+def collectMetrics():
+    # Values kept elsewhere, read whenever the endpoint is scraped
+    for result, hits in forecastCache.stats.items():
+        metrics.set("rainbypass_forecast_cache_total", hits, result=result)
+    for site in list(sites.values()):
+        metrics.set("rainbypass_fetch_breaker_open", int(time.time() < site["breaker"]["openUntil"]),
+            site="%s,%s" % site["key"])
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    # One command per line, each answered with one line of JSON:
+    #   status
+    #   open|close [zone=NAME] [hours=H]   force watering on or off
+    #   auto [zone=NAME]                   back to the forecast
+    #   refresh [zone=NAME]                check the forecast now
+    def handle(self):
+        for line in self.rfile:
+            self.wfile.write(controlReply(line.decode("utf-8", "replace").split()) + b"\n")
+
+def controlReply(words):
+    # Runs on the connection's thread. Status is the prebuilt snapshot;
+    # other commands run on the control thread, and are answered with the
+    # snapshot once they have.
+    if not words or words[0] == "status":
+        return statusSnapshot
+    options = dict(word.partition("=")[::2] for word in words[1:])
+    try:
+        if words[0] not in ("open", "close", "auto", "refresh") or options.keys() - {"zone", "hours"}:
+            raise ValueError("unknown command %r" % " ".join(words))
+        targets = [zone for zone in zones if options.get("zone", zone["name"]) == zone["name"]]
+        if not targets:
+            raise ValueError("no zone %r" % options["zone"])
+        hours = float(options["hours"]) if "hours" in options else None
+        if hours is not None and not 0 < hours < math.inf:
+            raise ValueError("hours must be positive")
+    except ValueError as error:
+        return json.dumps({"error": str(error)}).encode()
+    done = threading.Event()
+    scheduler.at(0, runControl, words[0], {zone["name"] for zone in targets}, hours, done)
+    if not done.wait(10):
+        return json.dumps({"error": "controller busy"}).encode()
+    return statusSnapshot
+
+def runControl(command, names, hours, done):
+    try:
+        if command == "refresh":
+            for site in sites.values():
+                if not site["tick"] and any(zone["name"] in names for zone in site["zones"]):
+                    site["breaker"]["openUntil"] = 0
+                    scheduleCheck(site, time.time())
+        else:
+            for zone in zones:
+                if zone["name"] in names:
+                    setOverride(zone, None if command == "auto" else command, hours)
+        publishStatus()
+    finally:
+        done.set()
+
+def startControl():
+    # Serve status and commands on a Unix socket next to the config file,
+    # unless controlSocket is off. Only users allowed to write to the
+    # socket (the owner and group) can connect.
+    global controlServer
+    if not config.get("controlSocket", True):
+        return
+    path = getCfgFile("sock")
+    with socket.socket(socket.AF_UNIX) as probe:
+        try:
+            probe.connect(path)
+            print("Control socket %s is in use by another instance." % path)
+            return
+        except OSError: # Nothing listening; remove any socket left by an earlier run
+            with contextlib.suppress(OSError):
+                os.remove(path)
+    try:
+        controlServer = socketserver.ThreadingUnixStreamServer(path, ControlHandler)
+        os.chmod(path, 0o660)
+    except OSError as error:
+        print("Control socket unavailable: %s" % error)
+        return
+    controlServer.daemon_threads = True
+    publishStatus()
+    threading.Thread(target=controlServer.serve_forever, daemon=True).start()
+    print("Control socket at %s" % path)
+
+def sendControl(words):
+    # Client side of --control: send one command to the running
+    # controller and print its reply
+    with socket.socket(socket.AF_UNIX) as client:
+        try:
+            client.connect(getCfgFile("sock"))
+        except OSError as error:
+            print("No controller listening on %s: %s" % (getCfgFile("sock"), error))
+            return
+        client.sendall((" ".join(words) + "\n").encode())
+        reply = client.makefile("rb").readline()
+    print(json.dumps(json.loads(reply), indent=2))
+
+class ForecastProxy:
+    # Serves hourly QPF to a fleet of controllers, fetching and parsing each
+    # forecast point once per update however many controllers ask for it.
+    # Requests for a point already being fetched wait for that one fetch.
+    # Points are rounded to 0.01 degree, as sites are. A point is held for
+    # the upstream freshness lifetime, and at least `hold` seconds. At most
+    # maxPoints are held; the least recently asked for is dropped first.
+    def __init__(self, upstreamURL, hold=600, timeout=30, maxPoints=1000):
+        self.upstreamURL, self.hold, self.timeout = upstreamURL, hold, timeout
+        self.maxPoints = maxPoints
+        self.lock = threading.Lock()
+        self.points = {} # key -> {"entry", "fetching" (an Event), "retryAt"}, least recently used first
+
+    def get(self, latValue, longValue):
+        # Returns the point's entry, or None, and how it was served
+        key = (round(latValue, 2), round(longValue, 2))
+        leader = False
+        with self.lock:
+            point = self.points.pop(key, None) or {"entry": None, "fetching": None, "retryAt": 0}
+            self.points[key] = point
+            while len(self.points) > self.maxPoints: # A dropped point's waiters keep their reference
+                del self.points[next(iter(self.points))]
+            if point["entry"] and point["entry"]["expires"] > time.time():
+                return point["entry"], "hit"
+            fetching = point["fetching"]
+            if not fetching and time.time() >= point["retryAt"]:
+                fetching = point["fetching"] = threading.Event()
+                leader = True
+        if leader:
+            try:
+                self.fetch(key, point)
+            finally:
+                with self.lock:
+                    point["fetching"] = None
+                fetching.set()
+        elif fetching:
+            fetching.wait(self.timeout)
+        entry = point["entry"]
+        if entry and entry["expires"] > time.time():
+            return entry, "fetched" if leader else "coalesced"
+        if entry and entry["end"] > currentHour(): # Upstream failing, serve what is left
+            return entry, "stale"
+        return None, "error"
+
+    def fetch(self, key, point):
+        entry = point["entry"]
+        try:
+            qpf, qpfTimes, headers = fetchForecast(self.upstreamURL % key, self.timeout,
+                validators=entry and entry["upstream"])
+        except Exception as error:
+            print("Proxy fetch for %s, %s failed: %s" % (key + (error,)))
+            point["retryAt"] = time.time() + random.uniform(5, 10) # Not again straight away
+            return
+        if qpf is None: # Not modified
+            body, qpfHour = entry["body"], entry["hour"]
+        else:
+            qpf, qpfHour = placeForecast(qpf, qpfTimes)
+            body = packForecast(qpf, qpfHour)
+        lifetime = max(cacheLifetime(headers) or 0, self.hold)
+        point["entry"] = {"body": body, "hour": qpfHour, "end": qpfHour + (len(body) - qpfHeader.size) // 4,
+            "etag": '"%08x"' % zlib.crc32(body), "expires": time.time() + lifetime,
+            "upstream": {"etag": headers.get("ETag"), "lastModified": headers.get("Last-Modified")}}
+
+class ProxyHandler(MetricsHandler):
+    # GET /qpf?lat=..&lon=.. for a point's forecast; /metrics as usual
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/qpf":
+            MetricsHandler.do_GET(self)
+            return
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            latValue, longValue = float(query["lat"][0]), float(query["lon"][0])
+        except (KeyError, ValueError):
+            self.send_error(400, "lat and lon required")
+            return
+        if not (abs(latValue) <= 90 and abs(longValue) <= 180): # Also rejects nan
+            self.send_error(400, "lat or lon out of range")
+            return
+        entry, served = self.server.proxy.get(latValue, longValue)
+        metrics.inc("rainbypass_proxy_requests_total", result=served)
+        if entry is None:
+            self.send_error(502, "Forecast unavailable")
+            return
+        notModified = self.headers.get("If-None-Match") == entry["etag"]
+        self.send_response(304 if notModified else 200)
+        self.send_header("ETag", entry["etag"])
+        self.send_header("Cache-Control", "max-age=%i" % max(entry["expires"] - time.time(), 0))
+        if notModified:
+            self.end_headers()
+            return
+        self.send_header("Content-Type", qpfContentType)
+        self.send_header("Content-Length", str(len(entry["body"])))
+        self.end_headers()
+        self.wfile.write(entry["body"])
+
+class ProxyServer(http.server.ThreadingHTTPServer):
+    request_queue_size = 256 # A fleet connects at once at the top of the hour
+    daemon_threads = True
+
+def serveProxy(proxy, port):
+    # Start serving proxy on a background thread; returns the server
+    server = ProxyServer(("", port), ProxyHandler)
+    server.proxy = proxy
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def runProxy(args):
+    proxy = ForecastProxy(args.upstream, args.proxy_hold, maxPoints=args.proxy_points)
+    server = serveProxy(proxy, args.proxy)
+    print("Serving forecasts from %s on port %i" % (args.upstream, server.server_address[1]))
+    print("Point controllers at it with forecastURL http://<this host>:%i/qpf?lat=%%s&lon=%%s" %
+        server.server_address[1])
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+def getCfgFile(extension="cfg"):
+    # Settings live in .cfg; rolling data in the .dat snapshot and .log journal
+    cfgName = "rain-bypass-3." + extension
     
     try:  # If running from command line __file__ path is defined
         return os.path.dirname(os.path.abspath(__file__)) + "/" + cfgName
     except:  # If __file__ is undefined, we are running from idle ide
         return os.getcwd() + "/" + cfgName
 
+def getStateFile(zone, extension):
+    # Named zones keep their rolling data in rain-bypass-3.<name>.dat/.log
+    return getCfgFile(zone["name"] + "." + extension if zone["name"] else extension)
+
+# Rolling data is kept out of the settings file. Each zone's snapshot is
+# one fixed-size record; each check appends a fixed-size record to the
+# zone's journal, which is folded into a new snapshot every compactEvery
+# records. A journal record's history value and forecast both start at the
+# hour of its time. A zone with a rain gauge also journals the hour before,
+# measured in full by then, in a double between the header and forecast
+# (flag 4).
+rollingKeys = ("time", "rainForecasted", "qpf", "historicalRain")
+snapshotHeader = struct.Struct("<4sqBxHHqq") # magic, time, flags, qpf and history lengths,
+                                             # hour of first qpf and newest history value
+snapshotHeaderV1 = struct.Struct("<4sqBxHH") # Both series at the hour of the time
+journalHeader = struct.Struct("<qBxHd")      # time, flags, qpf length, new history value
+seriesSize = 168 * 8                         # Each series is stored as 168 doubles
+compactEvery = 24
+
+def writeAtomic(path, data):
+    # Write to a temporary file and rename it over the old one, so a power
+    # cut leaves either the old or the new file, never a torn one
+    with open(path + ".tmp", "wb") as tmpFile:
+        tmpFile.write(data)
+        tmpFile.flush()
+        os.fsync(tmpFile.fileno())
+    os.replace(path + ".tmp", path)
+
+def saveSettings():
+    settings = {key: value for key, value in config.items() if key not in rollingKeys}
+    writeAtomic(getCfgFile(), json.dumps(settings).encode())
+
+def packSeries(values):
+    # Fixed-size block of 168 doubles; returns its length and bytes
+    values = array('d', values)[:168]
+    return len(values), (values + array('d', [0.0]) * (168 - len(values))).tobytes()
+
+def saveState(zone):
+    # Write a fresh snapshot, then empty the journal it now covers
+    qpfHour = max(zone["qpf"].first, zone["time"] // 3600) # Past hours are not needed
+    qpfLen, qpf = packSeries(zone["qpf"].series(qpfHour))
+    histLen, history = packSeries(zone["historicalRain"])
+    writeAtomic(getStateFile(zone, "dat"), snapshotHeader.pack(b"RBS2", zone["time"],
+        zone["rainForecasted"], qpfLen, histLen, qpfHour, zone["historicalRain"].newest or 0) + qpf + history)
+    with open(getStateFile(zone, "log"), "wb"):
+        pass
+    zone["journalRecords"] = 0
+
+def appendState(zone, historyCleared=False):
+    # Journal one check: its time, decision, history entry and forecast
+    hour = zone["time"] // 3600
+    qpfLen, qpf = packSeries(zone["qpf"].series(hour))
+    history = zone["historicalRain"]
+    held = len(history) and history.newest == hour and not historyCleared
+    previous = b""
+    if zone.get("gauge") and held and len(history) > 1:
+        previous = struct.pack("<d", history[1])
+    flags = zone["rainForecasted"] | (historyCleared << 1) | (bool(previous) << 2)
+    with open(getStateFile(zone, "log"), "ab") as journal:
+        journal.write(journalHeader.pack(zone["time"], flags, qpfLen, history[0] if held else 0.0) + previous + qpf)
+        journal.flush()
+        os.fsync(journal.fileno())
+    zone["journalRecords"] += 1
+    if zone["journalRecords"] >= compactEvery:
+        saveState(zone)
+
+def loadState(zone):
+    # Restore rolling data from the snapshot and replay the journal over it
+    with open(getStateFile(zone, "dat"), "rb") as stateFile:
+        data = stateFile.read()
+    if data[:4] == b"RBS2" and len(data) == snapshotHeader.size + 2 * seriesSize:
+        magic, stateTime, flags, qpfLen, histLen, qpfHour, historyHour = snapshotHeader.unpack_from(data)
+        start = snapshotHeader.size
+    elif data[:4] == b"RBS1" and len(data) == snapshotHeaderV1.size + 2 * seriesSize:
+        magic, stateTime, flags, qpfLen, histLen = snapshotHeaderV1.unpack_from(data)
+        qpfHour = historyHour = stateTime // 3600
+        start = snapshotHeaderV1.size
+    else:
+        raise ValueError("Unknown state file format")
+    qpf = array('d', data[start:start + 8 * qpfLen])
+    history = array('d', data[start + seriesSize:start + seriesSize + 8 * histLen])
+    history.reverse() # oldest first while replaying
+    
+    zone["journalRecords"] = 0
+    try:
+        with open(getStateFile(zone, "log"), "rb") as journal:
+            data = journal.read()
+    except FileNotFoundError:
+        data = b""
+    # A torn final record (power cut mid-write) is ignored
+    offset = 0
+    while offset + journalHeader.size + seriesSize <= len(data):
+        recordTime, recordFlags, recordLen, value = journalHeader.unpack_from(data, offset)
+        start = offset + journalHeader.size + (8 if recordFlags & 4 else 0)
+        if start + seriesSize > len(data):
+            break
+        offset = start + seriesSize
+        zone["journalRecords"] += 1
+        if recordTime <= stateTime: # Already in the snapshot
+            continue
+        stateTime, flags, hour = recordTime, recordFlags, recordTime // 3600
+        if flags & 4: # The hour before, as measured by the gauge
+            previous = struct.unpack_from("<d", data, start - 8)[0]
+            if len(history) and historyHour == hour - 1:
+                history[-1] = previous
+            elif len(history) > 1 and historyHour == hour:
+                history[-2] = previous
+        if flags & 2:
+            history = array('d')
+        elif len(history) and hour == historyHour: # Checked again in the same hour
+            history[-1] = value
+        elif len(history) and hour == historyHour + 1:
+            history.append(value)
+        else: # Nothing held before this hour
+            history = array('d', [value])
+        historyHour = hour
+        qpf, qpfHour = array('d', data[start:start + 8 * recordLen]), hour
+    
+    zone["time"] = stateTime
+    zone["rainForecasted"] = bool(flags & 1)
+    zone["qpf"], zone["qpfHour"] = qpf, qpfHour
+    zone["historicalRain"], zone["historyHour"] = history[-168:], historyHour # oldest first
+
+# Settings each zone may set for itself in config["zones"]; any it leaves
+# out are taken from the top level of the config
+zoneKeys = {"latValue": float, "longValue": float, "lookAhead": int, "lookBehind": int,
+            "rainfallLimit": float, "valveHasSensor": bool, "forceValve": bool,
+            "valveTimeout": int, "sensorDebounce": int, "decisionMode": str,
+            "cropCoefficient": float, "balanceLimit": float}
+
+def buildZones():
+    # One zone per entry in config["zones"], or without that list the
+    # single zone set at the top level, driven by the Pins defaults. Each
+    # zone's long-term archive is opened here too.
+    global zones
+
+    zones, names = [], set()
+    for settings in config.get("zones") or [{}]:
+        zone = {key: kind(settings.get(key, config.get(key, False))) for key, kind in zoneKeys.items()}
+        zone["lookAhead"] = min(zone["lookAhead"], 168)
+        zone["lookBehind"] = min(zone["lookBehind"], 168)
+        if zone["decisionMode"] not in ("rainfall", "balance"):
+            raise ValueError("Unknown decisionMode %r" % zone["decisionMode"])
+        zone["name"] = str(settings.get("name", ""))
+        if zone["name"] in names:
+            raise ValueError("Zone name %r used twice" % zone["name"])
+        names.add(zone["name"])
+        zone["pins"] = Pins()
+        for pin, number in settings.get("pins", {}).items():
+            if not hasattr(Pins, pin):
+                raise ValueError("Unknown pin %r in zone %r" % (pin, zone["name"]))
+            setattr(zone["pins"], pin, int(number))
+        zone.update(firstRun=True, valveMove=None, pendingMove=None, rainRate=None, netRate=None,
+            journalRecords=0, valve="unknown", override=None, pinOverride=None, gauge=None, gaugeHour=0,
+            remeasured=False)
+        try:
+            zone["archive"] = RainArchive(getStateFile(zone, "arc"))
+        except (OSError, ValueError) as e:
+            print("%sNo long-term archive: %s" % (zoneLabel(zone), e))
+            zone["archive"] = None
+        zones.append(zone)
+
+def groupSites():
+    # Zones whose points round to the same 0.01 degree (about 1 km, well
+    # inside one forecast grid cell) share a site: one fetch, one parse and
+    # one cached forecast. Each site is checked on its own schedule. The
+    # forecast cache is opened here too.
+    global sites
+    global forecastCache
+
+    forecastCache = ForecastCache(getCfgFile("cache"), config.get("cacheSize", 1048576))
+    sites = {}
+    for zone in zones:
+        key = (round(zone["latValue"], 2), round(zone["longValue"], 2))
+        if key not in sites:
+            sites[key] = {"key": key, "latValue": zone["latValue"], "longValue": zone["longValue"], "zones": [],
+                "qpf": zone["qpf"], "time": zone["time"], "due": math.inf, "checkEvent": None,
+                "tick": None, "breaker": {"failures": 0, "openUntil": 0},
+                "fetchers": [ForecastFetcher() for url in forecastSources()], "dataError": False,
+                "lastFetch": None}
+        site = sites[key]
+        site["zones"].append(zone)
+        # Keep the forecast reaching furthest ahead, and check as soon as
+        # any zone is due
+        if zone["qpf"].end > site["qpf"].end:
+            site["qpf"] = zone["qpf"]
+        site["time"] = min(site["time"], zone["time"])
+    for site in sites.values():
+        for zone in site["zones"]:
+            zone["qpf"] = site["qpf"]
+
 def loadConfig():
     global config
     global display
@@ -319,42 +2075,67 @@ def loadConfig():
     with open(getCfgFile(),"r") as configFile:
         print("Config file found, loading previous values...")
         config = json.load(configFile)
-
-    config["latValue"] = float(config["latValue"]) 
-    config["longValue"] = float(config["longValue"]) 
-    config["lookAhead"] = min(int(config["lookAhead"]),168)
-    config["lookBehind"] = min(int(config["lookBehind"]),168)
-    config["rainfallLimit"] = float(config["rainfallLimit"])
+    
     config["checkIncrement"] = int(config["checkIncrement"])
-    config["time"] = int(config["time"])
-    config["rainForecasted"] = bool(config["rainForecasted"])
-    config["forceValve"] = (bool(config['forceValve'])) if ('forceValve' in config) else False
-    config["valveHasSensor"] = bool(config["valveHasSensor"])
-    config["qpf"]
-    elapsedTime = int(time.time()) - config["time"]
-    print("Finished loading previous values.")
-    if config["time"] == 0: #config file was reset
-        config["time"] = int(time.time()) - config["checkIncrement"]
-    else:
-        print("Last check was %.2f minutes ago." % (elapsedTime/60))    
-        incrementsToSkip = int(elapsedTime/config["checkIncrement"])
-
-        while incrementsToSkip > 0:
-            if len(config["qpf"]) > (config["lookAhead"] + 1):
-                print("Catching up...")
-                # Add first value in forecast to beginning of historical data
-                config["historicalRain"].insert(0,config["qpf"][0])
-                # Trim end of historical data
-                del config["historicalRain"][168:]
-                # Delete first entry from forecast, now that it's moved
-                del config["qpf"][:1]
-                # One less increment to skip needed
-                incrementsToSkip -= 1
-            else:
+    config["forecastURL"] = config.get("forecastURL", defaultForecastURL)
+    config["hedgeURLs"] = list(config.get("hedgeURLs", [gridpointsURL]))
+    config["hedgeDelay"] = float(config.get("hedgeDelay", 5))
+    config["displayRefresh"] = int(config.get("displayRefresh", 60))
+    config["fetchTimeout"] = int(config.get("fetchTimeout", 30))
+    config["fetchDeadline"] = int(config.get("fetchDeadline", 300))
+    config["breakerThreshold"] = int(config.get("breakerThreshold", 5))
+    config["breakerCooldown"] = int(config.get("breakerCooldown", 900))
+    config["valveTimeout"] = int(config.get("valveTimeout", 30))
+    config["sensorDebounce"] = int(config.get("sensorDebounce", 50))
+    config["gaugeResolution"] = float(config.get("gaugeResolution", 0.01))
+    config["gaugeDebounce"] = int(config.get("gaugeDebounce", 10))
+    config["valveStagger"] = float(config.get("valveStagger", 2))
+    config["cacheSize"] = int(config.get("cacheSize", 1048576))
+    config["metricsPort"] = int(config.get("metricsPort", 0))
+    config["useGPIO"] = bool(config.get("useGPIO", True))
+    config["useOLED"] = bool(config.get("useOLED", True))
+    config["controlSocket"] = bool(config.get("controlSocket", True))
+    config["decisionMode"] = str(config.get("decisionMode", "rainfall"))
+    config["cropCoefficient"] = float(config.get("cropCoefficient", 0.8))
+    config["balanceLimit"] = float(config.get("balanceLimit", 0.0))
+    buildZones()
+
+    for zone in zones:
+        if "time" in config and not zone["name"]: # Older file holding everything, or a manual reset
+            zone["time"] = int(config["time"])
+            zone["rainForecasted"] = bool(config.get("rainForecasted", False))
+            zone["qpf"] = config.get("qpf", [])
+            zone["historicalRain"] = config.get("historicalRain", [])[::-1] # stored newest first
+            zone["qpfHour"] = zone["historyHour"] = zone["time"] // 3600
+        else: # Rolling data lives in the zone's state file
+            try:
+                loadState(zone)
+            except FileNotFoundError: # New zone, start it like a reset one
+                zone.update(time=0, rainForecasted=False, qpf=[], historicalRain=[], qpfHour=0, historyHour=0)
+        zone["qpf"] = RainForecast(zone["qpf"], zone.pop("qpfHour"))
+        zone["historicalRain"] = RainHistory(168, zone["historicalRain"], zone.pop("historyHour"))
+
+        elapsedTime = int(time.time()) - zone["time"]
+        if zone["time"] == 0: #config file was reset
+            zone["time"] = int(time.time()) - config["checkIncrement"]
+        else:
+            print("%sLast check was %.2f minutes ago." % (zoneLabel(zone), elapsedTime/60))
+            # Hours missed while stopped are filled from the cached forecast
+            skipped = fillHistory(zone, zone["qpf"], currentHour())
+            if skipped:
+                print("Catching up %i hour(s)..." % skipped)
+            elif skipped is None:
                 print("Insufficient cached data. Clearing stale historical data")
-                config["historicalRain"], config["qpf"] = [], []
-                incrementsToSkip = 0 
-                config["time"] = int(time.time()) - config["checkIncrement"] + 60
+                zone["time"] = int(time.time()) - config["checkIncrement"] + 60
+    for key in rollingKeys:
+        config.pop(key, None)
+    groupSites()
+    print("Finished loading previous values.")
+
+    # Fold any journal and older all-in-one config files into fresh snapshots
+    for zone in zones:
+        saveState(zone)
+    saveSettings()
 
 def buildConfig():
     global config
@@ -383,165 +2164,726 @@ def buildConfig():
     # request number of checks in 24 hour period
     # checkIncrement = int(input("Enter number of times you want to check forecast per 24-hour period " + \
     #                           "(no more than 500, try 24, or once per hour): "))
-    checkIncrement = 24 # Must check once per hour for lookback feature to work
+    checkIncrement = 24 # Once per hour; more often is fine, each hour's history is overwritten
     config["checkIncrement"] = int(86400/checkIncrement) # This is the wait interval between each check in seconds
+    config["forecastURL"] = defaultForecastURL # %s placeholders for latitude, longitude
+    config["hedgeURLs"] = [gridpointsURL] # Also tried when forecastURL is slow or fails
+    config["hedgeDelay"] = 5 # Seconds before trying the next source, until its p95 is known
+    config["displayRefresh"] = 60 # Seconds between countdown updates on the display
+    config["fetchTimeout"] = 30 # Seconds allowed for one forecast download
+    config["fetchDeadline"] = 300 # Seconds to keep retrying before using cached data
+    config["breakerThreshold"] = 5 # Failed downloads in a row before pausing fetches
+    config["breakerCooldown"] = 900 # Seconds to pause fetches for
+    config["valveTimeout"] = 30 # Seconds to wait for the valve to reach position
+    config["sensorDebounce"] = 50 # Milliseconds for a valve sensor contact to settle
+    config["gaugeResolution"] = 0.01 # Inches of rain per tip of a rain gauge on Pins.RainGauge
+    config["gaugeDebounce"] = 10 # Milliseconds a gauge contact is left to settle before it is read
+    config["valveStagger"] = 2 # Seconds between starting the moves of different valves
+    config["cacheSize"] = 1048576 # Bytes of forecast responses kept on disk
+    config["metricsPort"] = 0 # TCP port for the Prometheus metrics endpoint, 0 for none
+    config["useGPIO"] = True # False to run without valves (as --headless does)
+    config["useOLED"] = True # False to skip looking for the OLED display
+    config["controlSocket"] = True # Serve status and commands on rain-bypass-3.sock
+    config["decisionMode"] = "rainfall" # "balance" to weigh rain against evapotranspiration
+    config["cropCoefficient"] = 0.8 # Crop ET as a fraction of reference ET, in balance mode
+    config["balanceLimit"] = 0.0 # Rain less crop ET, in inches/week, that disables watering
+    config.pop("zones", None) # Further zones are added by editing the config file
+    buildZones()
 
-    # Create arrays for cached and historical Quantitative Precipitation Forecast values
-    config["qpf"] = []
-    config["historicalRain"] = []
+    for zone in zones:
+        # Create arrays for cached and historical Quantitative Precipitation Forecast values
+        zone["qpf"] = RainForecast()
+        zone["historicalRain"] = RainHistory(168)
 
-    # Create forecase placeholder
-    config["rainForecasted"] = False
+        # Create forecase placeholder
+        zone["rainForecasted"] = False
+        zone["time"] = int(time.time()) - config["checkIncrement"] # Update timestamp
+    groupSites()
     
     # Save user input to new config file
-    config["time"] = int(time.time()) - config["checkIncrement"] # Update timestamp
-    with open(getCfgFile(),"w") as configFile:
-        json.dump(config, configFile)
+    saveSettings()
+    for zone in zones:
+        saveState(zone)
         
     PrintConfig()
 
-def processForecast(qpf):
-    global config
+def currentHour():
+    return int(time.time() // 3600)
+
+def fillHistory(zone, forecast, hour):
+    # Record the hours between the zone's newest history entry and `hour`
+    # from the forecast covering them. Returns how many were filled, or
+    # None if they were not all covered and the history was cleared.
+    history = zone["historicalRain"]
+    if not len(history) or history.newest >= hour - 1:
+        return 0
+    missed = range(history.newest + 1, hour)
+    if forecast.at(missed[0]) is None or forecast.at(missed[-1]) is None:
+        history.clear()
+        return None
+    for missedHour in missed:
+        history.record(missedHour, forecast.at(missedHour))
+        archiveHour(zone, missedHour, forecast=forecast.at(missedHour))
+    return len(missed)
+
+def archiveHour(zone, hour, **values):
+    # Add to the zone's long-term archive; a failed write loses only that hour
+    if zone.get("archive") is not None:
+        try:
+            zone["archive"].record(hour, **values)
+        except OSError as e:
+            print("%sCould not archive hour: %s" % (zoneLabel(zone), e))
+
+def processForecast(zone, qpf, hour, et=None):
     global display
     
-    # Add current rain amount to front of historical list and trim to 7 days
-    config["historicalRain"].insert(0,qpf[0]) 
-    del config["historicalRain"][168:]
+    started = time.perf_counter()
+    # Record the current hour's rain in the history (kept to 7 days). A
+    # later check in the same hour overwrites it.
+    history = zone["historicalRain"]
+    gauge = zone["gauge"]
+    if gauge and hour >= gauge.first:
+        # Measured rain replaces the forecast for every hour the gauge has
+        # seen whole since the last check, and for the current hour so far
+        # along with the forecast's share of the rest of it
+        gauge.collect()
+        for measured in range(max(gauge.first, zone["gaugeHour"]), hour):
+            history.record(measured, gauge.rain(measured))
+            archiveHour(zone, measured, observed=gauge.rain(measured))
+            # The hour before this one goes in the check's journal record;
+            # any earlier take a snapshot
+            zone["remeasured"] = zone["remeasured"] or measured < hour - 1
+        zone["gaugeHour"] = hour
+        history.record(hour, gauge.rain(hour) + (qpf.at(hour) or 0.0) * (1 - time.time() % 3600 / 3600))
+    else:
+        history.record(hour, qpf.at(hour) or 0.0)
     
     # If there's not enough historical data, look ahead more
-    histLen = len(config["historicalRain"])
-    lookAhead = config["lookAhead"]
-    if histLen < config["lookBehind"]:
-        print("Only %s hour(s) of historical data available --" % histLen)
-        lookAhead = min(lookAhead + config["lookBehind"] - histLen,168)
+    histLen = len(history)
+    lookAhead, aheadHours, behindHours = rainWindows(histLen, qpf.remaining(hour),
+        zone["lookAhead"], zone["lookBehind"])
+    if histLen < zone["lookBehind"]:
+        print("%sOnly %s hour(s) of historical data available --" % (zoneLabel(zone), histLen))
         print("    looking ahead %s hours." % lookAhead)
 
-    # Total rainfall ahead and behind. First value in qpf is skipped,
-    # as it is the current hour (and is counted in config["historicalRain"])
-    sampledRain = qpf[1:lookAhead + 1] + \
-        config["historicalRain"][:config["lookBehind"]]
+    # Total rainfall ahead and behind. The current hour is counted in
+    # zone["historicalRain"], so the forecast is summed from the next one
+    rainRate, rainForecasted = decideRain(qpf.sum(hour + 1, hour + lookAhead + 1), aheadHours,
+        history.sum(hour - behindHours + 1, hour + 1), behindHours, zone["rainfallLimit"])
+    netRate = None
+    if zone["decisionMode"] == "balance":
+        # ET is summed over whole days from the next hour, so the rate does
+        # not swing between day and night with the look-ahead
+        etHours = min(-(-aheadHours // 24) * 24, et.remaining(hour + 1)) if et else 0
+        if etHours > 0:
+            etRate, rainForecasted = decideBalance(rainRate, et.sum(hour + 1, hour + etHours + 1), etHours,
+                zone["cropCoefficient"], zone["balanceLimit"])
+            netRate = rainRate - etRate
+            metrics.set("rainbypass_et_rate", etRate, zone=zone["name"])
+        else:
+            print("%sNo evapotranspiration forecast, deciding on rainfall alone." % zoneLabel(zone))
+    metrics.observe("rainbypass_decide_seconds", time.perf_counter() - started, zone=zone["name"])
+    metrics.set("rainbypass_rain_rate", rainRate, zone=zone["name"])
+    archiveHour(zone, hour, forecast=qpf.at(hour), rainRate=rainRate, disabled=float(rainForecasted))
 
     # Check if rainfall exceeds rate
-    rainRate = 168 * float(sum(sampledRain) / len(sampledRain))
-    if (rainRate > config["rainfallLimit"]):
-        print("Forecasted rainfall of %s in/wk exceeds limit of %s in/wk." %
-              (round(rainRate,3), config['rainfallLimit']))
-        rainForecasted = True
+    if netRate is not None:
+        print("%sForecasted rainfall of %s in/wk less %s in/wk evapotranspiration leaves %s in/wk," %
+            (zoneLabel(zone), round(rainRate,3), round(etRate,3), round(netRate,3)))
+        print("    %s the %s in/wk limit." % ("at or above" if rainForecasted else "below", zone["balanceLimit"]))
+    elif rainForecasted:
+        print("%sForecasted rainfall of %s in/wk exceeds limit of %s in/wk." %
+              (zoneLabel(zone), round(rainRate,3), zone['rainfallLimit']))
     else:
-        print("Forecasted rainfall of %s in/wk is less than %s in/wk limit." %
-            (round(rainRate,3), config['rainfallLimit']))
-        rainForecasted = False
+        print("%sForecasted rainfall of %s in/wk is less than %s in/wk limit." %
+            (zoneLabel(zone), round(rainRate,3), zone['rainfallLimit']))
     
-    display[2] = "%.1f in/wk rain fcst" % rainRate
-    updateOLED()
+    zone["rainRate"], zone["netRate"] = rainRate, netRate
+    if len(zones) <= 1:
+        display[2] = "%+.1f in/wk net water" % netRate if netRate is not None else "%.1f in/wk rain fcst" % rainRate
+        updateOLED()
     
     return rainForecasted
 
-def ModifyWatering(rainForecasted):
+# The decision rule as pure functions, shared by processForecast() and the
+# replay engine. They must work on plain ints and on NumPy arrays alike.
+def rainWindows(histLen, forecastLen, lookAhead, lookBehind, minimum=min, maximum=max):
+    # Returns the look-ahead actually used (extended while history is
+    # short) and the number of hours sampled ahead and behind. Pass
+    # np.minimum and np.maximum to evaluate it over arrays.
+    lookAhead = minimum(lookAhead + maximum(lookBehind - histLen, 0), 168)
+    return lookAhead, minimum(lookAhead, forecastLen - 1), minimum(lookBehind, histLen)
+
+def decideRain(aheadRain, aheadHours, behindRain, behindHours, rainfallLimit):
+    # Rain totals are in micro-inches. Returns the rate in inches per week
+    # and whether it exceeds rainfallLimit (watering should be disabled).
+    rainRate = 168 * (aheadRain + behindRain) / 1000000 / (aheadHours + behindHours)
+    return rainRate, rainRate > rainfallLimit
+
+def decideBalance(rainRate, etAhead, etHours, cropCoefficient, balanceLimit):
+    # Water balance: the rain rate less the crop's evapotranspiration, from
+    # the reference ET forecast over etHours (micro-inches). Past ET is not
+    # kept, so the hours behind are taken to lose water at the same rate.
+    # Returns the ET rate in inches per week and whether the balance
+    # reaches balanceLimit (watering should be disabled).
+    etRate = 168 * etAhead / 1000000 / etHours * cropCoefficient
+    return etRate, rainRate - etRate >= balanceLimit
+
+def siteET(site, columns, hour):
+    # The reference ET forecast for a site, if any of its zones use it
+    if all(zone["decisionMode"] != "balance" for zone in site["zones"]):
+        return None
+    return forecastET(columns, hour, site["latValue"], site["longValue"])
+
+def forecastET(columns, hour, latitude, longitude):
+    # Hourly FAO-56 Penman-Monteith reference evapotranspiration (short
+    # grass) from the forecast columns, vectorized over the hours. Solar
+    # radiation comes from the sun's position and the cloud cover, the
+    # sustained wind is taken at 10 m, and the pressure at sea level.
+    # Returns a RainForecast in inches per hour from `hour`, or None
+    # without NumPy or the series it needs.
+    global np
+    if np is None:
+        try:
+            import numpy as np
+        except ImportError:
+            print("Balance mode needs NumPy (sudo apt install python3-numpy).")
+            return None
+    if not {"temperature", "windSpeed", "cloudCover"} <= columns.keys() or \
+            not ("dewPoint" in columns or "humidity" in columns):
+        return None
+    temp = (np.array(columns["temperature"], float) - 32) / 1.8 # deg C
+    es = 0.6108 * np.exp(17.27 * temp / (temp + 237.3))        # Saturation vapour pressure, kPa
+    ea = np.full_like(temp, np.nan)                             # Actual vapour pressure
+    if "dewPoint" in columns:
+        dew = (np.array(columns["dewPoint"], float) - 32) / 1.8
+        ea = 0.6108 * np.exp(17.27 * dew / (dew + 237.3))
+    if "humidity" in columns:
+        ea = np.where(np.isnan(ea), es * np.array(columns["humidity"], float) / 100, ea)
+    wind = np.array(columns["windSpeed"], float) * 0.44704 * 0.748 # mph at 10 m to m/s at 2 m
+    clear = 1 - np.array(columns["cloudCover"], float) / 100
+
+    # Extraterrestrial radiation over each hour, MJ/m2 (FAO-56 eq. 28)
+    hours = hour + np.arange(len(temp))
+    stamps = (hours * 3600).astype("datetime64[s]")
+    day = (stamps.astype("datetime64[D]") - stamps.astype("datetime64[Y]")).astype(int) + 1
+    b = 2 * math.pi * (day - 81) / 364
+    solarTime = hours % 24 + 0.5 + longitude / 15 + 0.1645 * np.sin(2 * b) - 0.1255 * np.cos(b) - 0.025 * np.sin(b)
+    omega = math.pi / 12 * (solarTime - 12)
+    phi = math.radians(latitude)
+    decl = 0.409 * np.sin(2 * math.pi * day / 365 - 1.39)
+    sunset = np.arccos(np.clip(-math.tan(phi) * np.tan(decl), -1, 1))
+    w1 = np.clip(omega - math.pi / 24, -sunset, sunset)
+    w2 = np.clip(omega + math.pi / 24, -sunset, sunset)
+    ra = 12 * 60 / math.pi * 0.0820 * (1 + 0.033 * np.cos(2 * math.pi * day / 365)) * \
+        ((w2 - w1) * math.sin(phi) * np.sin(decl) + math.cos(phi) * np.cos(decl) * (np.sin(w2) - np.sin(w1)))
+
+    # Net radiation: shortwave with albedo 0.23, less longwave (eq. 38-40),
+    # the sunshine fraction taken as the clear part of the sky
+    relative = (0.25 + 0.5 * clear) / 0.75 # Rs/Rso
+    rn = 0.77 * relative * 0.75 * ra - \
+        2.043e-10 * (temp + 273.16) ** 4 * (0.34 - 0.14 * np.sqrt(ea)) * (1.35 * relative - 0.35)
+    soil = np.where(ra > 0, 0.1, 0.5) * rn
+    slope = 4098 * es / (temp + 237.3) ** 2
+    gamma = 0.0674 # kPa/C at sea level
+    et = (0.408 * slope * (rn - soil) + gamma * 37 / (temp + 273) * wind * (es - ea)) / \
+        (slope + gamma * (1 + 0.34 * wind))
+    et = np.maximum(et, 0) / 25.4 # mm to inches
+    if np.isnan(et).all():
+        return None
+    # Hours missing a value are taken at the mean of the rest
+    return RainForecast(np.where(np.isnan(et), np.nanmean(et), et).tolist(), hour)
+
+def overrideOf(zone):
+    # "open" or "close" while the valve is forced, a Bypass switch winning
+    # over a control command, else None
+    return zone["pinOverride"] or (zone["override"]["mode"] if zone["override"] else None)
+
+def wateringDisabled(zone):
+    # The state the valve is sent to: forced, or else the decision
+    override = overrideOf(zone)
+    return override == "close" if override else zone["rainForecasted"]
+
+def readBypass(zone):
+    # Bypass switches close to ground; BypassDisable wins if both are on
+    pins = zone["pins"]
+    if pins.BypassDisable and not GPIO.input(pins.BypassDisable):
+        return "close"
+    if pins.BypassEnable and not GPIO.input(pins.BypassEnable):
+        return "open"
+    return None
+
+def bypassChanged(zone):
+    try:
+        override = readBypass(zone)
+    except Exception as error:
+        print(error)
+        return
+    if override != zone["pinOverride"]:
+        zone["pinOverride"] = override
+        print("%sBypass switch %s" % (zoneLabel(zone), {"open": "forces watering ON",
+            "close": "forces watering OFF", None: "released"}[override]))
+        queueValveMove(zone, zone["rainForecasted"])
+        publishStatus()
+
+def setOverride(zone, mode, hours=None):
+    # Force a zone's valve "open" or "close", for a number of hours or
+    # until told otherwise, or hand it back to the forecast with None
+    if zone["override"]:
+        scheduler.cancel(zone["override"]["event"])
+    zone["override"] = None
+    if mode:
+        until = int(time.time() + hours * 3600) if hours else None
+        zone["override"] = {"mode": mode, "until": until,
+            "event": scheduler.at(until, setOverride, zone, None) if until else None}
+        print("%sWatering forced %s%s" % (zoneLabel(zone), "ON" if mode == "open" else "OFF",
+            " until %s" % time.ctime(until) if until else ""))
+    else:
+        print("%sWatering back on the forecast" % zoneLabel(zone))
+    queueValveMove(zone, zone["rainForecasted"])
+    publishStatus()
+
+def queueValveMove(zone, rainForecasted):
+    # Valve moves run concurrently, but start valveStagger seconds apart
+    # so several motors never start on the same supply at once. A forced
+    # state (Bypass switch or control command) wins over the decision.
+    global nextValveSlot
+
+    override = overrideOf(zone)
+    if override:
+        rainForecasted = override == "close"
+    scheduler.cancel(zone["pendingMove"])
+    now = time.time()
+    when = max(now, nextValveSlot)
+    nextValveSlot = when + config.get("valveStagger", 2)
+    if when <= now:
+        zone["pendingMove"] = None
+        ModifyWatering(zone, rainForecasted)
+    else:
+        zone["pendingMove"] = scheduler.at(when, ModifyWatering, zone, rainForecasted)
+
+def ModifyWatering(zone, rainForecasted):
     global display
-    global firstRun
     
-    firstRun = False
+    zone["firstRun"] = False
+    zone["pendingMove"] = None
+    finishValveMove(zone, None) # Stop any move still in progress
     
     oldLine4 = display[4]
+    pins = zone["pins"]
+    valveName = zone["name"] or "valve"
     
     if(rainForecasted == False):
-        display[3] = "Watering ENABLED"
-        display[4] = "Opening valve..."
-        print("%s. %s" % (display[3], display[4]))
-        updateOLED()
-        try:
-            GPIO.output(Pins.OpenRelay, True)  # Open valve to...
-            GPIO.output(Pins.CloseRelay, False)  # enable watering
-            GPIO.output(Pins.EnabledLED, True)  # Turn on green light
-            GPIO.output(Pins.DisabledLED, False) # Turn off red light
-            now = int(time.time())
-            while (int(time.time()) < now + 30) and GPIO.input(Pins.OpenSensor):
-                # wait for valve to open or 30 seconds to elapse
-                time.sleep(1)
-            if GPIO.input(Pins.OpenSensor):
-                if config["valveHasSensor"]:
-                    display[4] = "Valve opening FAILED"
-                    print(display[4])
-                    updateOLED()
-                else:
-                    display[4] = oldLine4
-                    updateOLED()
-            else:
-                display[4] = oldLine4
-                updateOLED()
-        except Exception as error:
-            print(error)
+        display[4] = "Opening %s..." % valveName
+        sensorPin = pins.OpenSensor
     else:
-        display[3] = "Watering DISABLED"
-        display[4] = "Closing valve..."
-        print("%s. %s" % (display[3], display[4]))
-        updateOLED()
+        display[4] = "Closing %s..." % valveName
+        sensorPin = pins.ClosedSensor
+    print("%sWatering %s. %s" % (zoneLabel(zone), "DISABLED" if rainForecasted else "ENABLED", display[4]))
+    zone["valve"] = "closing" if rainForecasted else "opening"
+    showZones()
+    if GPIO is None: # Headless, no valve to move
+        display[4] = oldLine4
+        zone["valve"] = "none"
+        publishStatus()
+        return
+    try:
+        GPIO.output(pins.OpenRelay, not rainForecasted)  # Open valve to enable watering,
+        GPIO.output(pins.CloseRelay, rainForecasted)     # or close it to disable
+        GPIO.output(pins.EnabledLED, not rainForecasted) # Green light when watering
+        GPIO.output(pins.DisabledLED, rainForecasted)    # Red light when disabled
+    except Exception as error:
+        print(error)
+        metrics.inc("rainbypass_valve_moves_total", zone=zone["name"], result="error")
+        finishValveMove(zone, None)
+        zone["valve"] = "failed"
+        publishStatus()
+        return
+    publishStatus()
+
+    # The move finishes in the background, when the sensor has settled in
+    # the new position or when valveTimeout seconds elapse
+    zone["valveMove"] = move = {"opening": not rainForecasted, "pin": sensorPin, "oldLine4": oldLine4,
+        "started": time.time(), "lastEdge": 0, "check": None, "polling": False,
+        "timeout": scheduler.after(zone["valveTimeout"], finishValveMove, zone, False)}
+    try:
+        if not GPIO.input(sensorPin): # Already in position
+            finishValveMove(zone, True)
+            return
+        # Every edge restarts the debounce timer, so bouncing contacts are
+        # only trusted once they have been quiet for sensorDebounce ms
+        GPIO.add_event_detect(sensorPin, GPIO.BOTH, callback=lambda channel: valveSensorEdge(zone, channel))
+    except Exception as error: # No edge detection, sample the sensor instead
+        print(error)
+        move["polling"] = True
+        checkValveSensor(zone)
+
+def valveSensorEdge(zone, channel):
+    # Called from the GPIO thread
+    move = zone["valveMove"]
+    if move and move["pin"] == channel:
+        move["lastEdge"] = time.time()
+        if not move["check"]:
+            move["check"] = scheduler.after(zone["sensorDebounce"] / 1000, checkValveSensor, zone)
+
+def checkValveSensor(zone):
+    move = zone["valveMove"]
+    if not move:
+        return
+    debounce = zone["sensorDebounce"] / 1000
+    lastEdge = move["lastEdge"]
+    quiet = time.time() - lastEdge
+    move["check"] = None
+    if quiet < debounce: # Contact still bouncing
+        move["check"] = scheduler.after(debounce - quiet, checkValveSensor, zone)
+        return
+    try:
+        reached = not GPIO.input(move["pin"])
+    except Exception as error:
+        print(error)
+        reached = False
+    if reached:
+        finishValveMove(zone, True)
+    elif move["polling"] or move["lastEdge"] != lastEdge:
+        move["check"] = scheduler.after(debounce, checkValveSensor, zone)
+
+def finishValveMove(zone, reached):
+    # reached is True when the sensor confirmed the move, False on timeout
+    # and None when the move was interrupted
+    global display
+    
+    move, zone["valveMove"] = zone["valveMove"], None
+    if move:
+        scheduler.cancel(move["timeout"])
+        scheduler.cancel(move["check"])
         try:
-            GPIO.output(Pins.OpenRelay, False) # Close valve to...
-            GPIO.output(Pins.CloseRelay, True)   # disable watering
-            GPIO.output(Pins.EnabledLED, False) # Turn off green light
-            GPIO.output(Pins.DisabledLED, True)  # Turn on red light
-            now = int(time.time())
-            while (int(time.time()) < now + 30) and GPIO.input(Pins.ClosedSensor):
-                # wait for valve to open or 30 seconds to elapse
-                time.sleep(1)
-            if GPIO.input(Pins.ClosedSensor):
-                if config["valveHasSensor"]:
-                    display[4] = "Valve closing FAILED"
-                    print(display[4])
-                    updateOLED()
-            else:
-                display[4] = oldLine4
-                updateOLED()
-        except Exception as error:
-            print(error)
+            GPIO.remove_event_detect(move["pin"])
+        except Exception:
+            pass
+        if reached is not None:
+            print("%sValve %s after %.2f seconds." % (zoneLabel(zone), "moved" if reached else "move timed out",
+                time.time() - move["started"]))
+            metrics.observe("rainbypass_valve_move_seconds", time.time() - move["started"], zone=zone["name"])
+        metrics.inc("rainbypass_valve_moves_total", zone=zone["name"],
+            result="interrupted" if reached is None else "moved" if reached else "timeout")
+        if reached is not None: # Without a sensor, a timeout is how every move ends
+            zone["valve"] = "failed" if reached is False and zone["valveHasSensor"] else \
+                "open" if move["opening"] else "closed"
+            publishStatus()
+        if reached is False and zone["valveHasSensor"]:
+            display[4] = "%s %s FAILED" % (zone["name"] or "Valve", "opening" if move["opening"] else "closing")
+            print(display[4])
+        elif any(other["valveMove"] for other in zones):
+            pass # Leave the other move's progress on screen
+        elif countdownEvent and countdownEvent[2]:
+            countdown(*countdownEvent[3]) # Bring the countdown back now
+        else:
+            display[4] = move["oldLine4"]
+        updateOLED()
 
+    if GPIO is None:
+        return
     try:
-        GPIO.output(Pins.OpenRelay, False) # Close both relays...
-        GPIO.output(Pins.CloseRelay, False)  # before exiting
+        GPIO.output(zone["pins"].OpenRelay, False) # Close both relays...
+        GPIO.output(zone["pins"].CloseRelay, False)  # once the move is over
     except Exception as error:
         print(error)
 
 def getIP():
-    cmd = "hostname -I | cut -d\' \' -f1"
-    IP = subprocess.check_output(cmd, shell=True).decode("utf-8")
-    return IP
+    # Address used for outbound traffic, found in-process. Connecting a UDP
+    # socket only selects a route and source address, no packet is sent.
+    # This takes about 10 us, less than telling whether the network changed.
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(("192.0.2.1", 9)) # TEST-NET-1, never reached
+            return s.getsockname()[0]
+    except OSError: # No route yet
+        return ""
+
 
+def setupOLED(disp):
+    global display
+    global renderer
+    global Image, ImageDraw, ImageFont
+    # disp is an SSD1306_I2C, or bench/fakes.py's FakeSSD1306 when benchmarking
+    from PIL import Image, ImageDraw, ImageFont
+    display[0] = disp
+    display[0].fill(0)
+    display[0].show()
+    
+    display[5] = Image.new('1', (display[0].width, display[0].height))
+    display[6] = ImageDraw.Draw(display[5])
+    display[7] = ImageFont.load_default()
+    renderer = OLEDRenderer(display[0], display[5], display[6], display[7])
+    renderer.start()
 
 def updateOLED():
     global display
-    if display[0]:
+    if renderer:
         # display[0] is disp object
         # display[1] - [4] are lines 1-4 of text
         # display[5] is the image object
         # display[6] is the draw object
         # display[7] is the font
-        
-        display[6].rectangle((0, 0, display[0].width, display[0].height), outline=0, fill=0)
-        display[6].text((0, -2), display[1], font=display[7], fill=255)
-        display[6].text((0,  6), display[2], font=display[7], fill=255)
-        display[6].text((0, 14), display[3], font=display[7], fill=255)
-        display[6].text((0, 22), display[4], font=display[7], fill=255)
-        display[0].image(display[5])
-        display[0].show()
+        # Drawing happens on the renderer thread; this never blocks
+        renderer.update(display[1:5])
+
+# Offline replay of the decision rule over an archive of past forecasts,
+# sweeping lookAhead, lookBehind and rainfallLimit
+
+def loadArchive(path):
+    # CSV, one row per hourly check: unix time, observed rain for that hour
+    # in inches (blank if unknown), then the hourly forecast (in/hr) fetched
+    # at that check, current hour first. A row with too short a forecast is
+    # a failed fetch. Returns forecasts in micro-inches, their lengths and
+    # observed rain (NaN where unknown).
+    forecasts, observed = [], []
+    with open(path, newline="") as archiveFile:
+        for row in csv.reader(archiveFile):
+            if not row or not row[0].strip().isdigit(): # Header or blank line
+                continue
+            observed.append(float(row[1]) if len(row) > 1 and row[1].strip() else float("nan"))
+            forecasts.append([toMicro(float(value)) for value in row[2:] if value.strip()])
+    lengths = np.array([len(forecast) for forecast in forecasts], np.int64)
+    matrix = np.zeros((len(forecasts), max(lengths.max(initial=0), 1)), np.int64)
+    for i, forecast in enumerate(forecasts):
+        matrix[i, :len(forecast)] = forecast
+    return {"forecasts": matrix, "lengths": lengths, "observed": np.array(observed),
+            "prefix": np.concatenate((np.zeros((len(matrix), 1), np.int64), matrix.cumsum(axis=1)), axis=1)}
+
+def replaySources(lengths, lookAhead):
+    # Which archived forecast, and how far into it, each hour's decision
+    # uses, following decideForecast(): a fresh forecast if it is long
+    # enough, else the cached one from this hour on, else none (-1)
+    source, offset = np.full(len(lengths), -1), np.zeros(len(lengths), np.int64)
+    cacheRow = -1
+    for hour, length in enumerate(lengths):
+        if length >= lookAhead:
+            cacheRow = hour
+        elif cacheRow < 0 or lengths[cacheRow] - (hour - cacheRow) < lookAhead:
+            continue
+        source[hour], offset[hour] = cacheRow, hour - cacheRow
+    return source, offset
+
+def replayDecisions(archive, lookAhead, lookBehind, limits, sources=None):
+    # Evaluate the live rule for every archived hour at once. Returns the
+    # rain rates, a (limits x hours) array of decisions and the hours with
+    # enough data to decide; other hours water, as the live path does.
+    source, offset = sources or replaySources(archive["lengths"], lookAhead)
+    valid = source >= 0
+    row = np.where(valid, source, 0)
+    hours = np.arange(len(source))
+    
+    # History: the current-hour forecast, cleared whenever data ran out
+    history = np.where(valid, archive["forecasts"][row, offset], 0)
+    historySums = np.concatenate(([0], history.cumsum()))
+    lastReset = np.maximum.accumulate(np.where(valid, -1, hours))
+    histLen = np.minimum(hours - lastReset, 168)
+    
+    lookAheads, aheadHours, behindHours = rainWindows(histLen, archive["lengths"][row] - offset,
+        lookAhead, lookBehind, np.minimum, np.maximum)
+    aheadRain = archive["prefix"][row, offset + 1 + aheadHours] - archive["prefix"][row, offset + 1]
+    behindRain = historySums[hours + 1] - historySums[hours + 1 - behindHours]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rainRate, _ = decideRain(aheadRain, aheadHours, behindRain, behindHours, 0)
+    decisions = (rainRate[np.newaxis, :] > np.asarray(limits)[:, np.newaxis]) & valid
+    return rainRate, decisions, valid
+
+def replayWorker(archivePath):
+    global replayArchive
+    global np
+    import numpy as np # Workers started without fork import it again
+    replayArchive = loadArchive(archivePath)
+
+def replaySweep(lookAhead, lookBehinds, limits, weeklyWater):
+    # One process pool task: every lookBehind and limit for one lookAhead
+    archive = replayArchive
+    sources = replaySources(archive["lengths"], lookAhead)
+    observed = np.nan_to_num(archive["observed"])
+    known = (~np.isnan(archive["observed"])).astype(np.int64)
+    observedSums = np.concatenate(([0], observed.cumsum()))
+    knownSums = np.concatenate(([0], known.cumsum()))
+    hours = np.arange(len(observed))
+    results = []
+    for lookBehind in lookBehinds:
+        rainRate, decisions, valid = replayDecisions(archive, lookAhead, lookBehind, limits, sources)
+        # Rain that actually fell over the same window the rule looks at
+        first, last = np.maximum(hours - lookBehind + 1, 0), np.minimum(hours + lookAhead + 1, len(hours))
+        seen = knownSums[last] - knownSums[first]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            actualRate = 168 * (observedSums[last] - observedSums[first]) / seen
+        scored = seen == last - first # Windows with complete observations
+        for limit, disabled in zip(limits, decisions):
+            wet = actualRate > limit
+            results.append((lookAhead, lookBehind, limit, int(disabled.sum()),
+                disabled.sum() / 168 * weeklyWater,
+                int((disabled & scored & ~wet).sum()),   # Disabled though it stayed dry
+                int((~disabled & scored & wet).sum())))  # Watered though it rained
+    return results
+
+def replayLive(archive, lookAhead, lookBehind, limit):
+    # Run the archive through the live processForecast() path, for checking
+    # the vectorized replay against it
+    zone = {"name": "", "lookAhead": lookAhead, "lookBehind": lookBehind, "rainfallLimit": limit,
+            "decisionMode": "rainfall", "gauge": None, "qpf": RainForecast(), "historicalRain": RainHistory(168)}
+    decisions = []
+    with open(os.devnull, "w") as quiet, contextlib.redirect_stdout(quiet):
+        for hour, (row, length) in enumerate(zip(archive["forecasts"], archive["lengths"])):
+            if length >= lookAhead:
+                zone["qpf"].load(row[:length] / 1000000, hour)
+                decisions.append(processForecast(zone, zone["qpf"], hour))
+            elif zone["qpf"].remaining(hour) >= lookAhead:
+                decisions.append(processForecast(zone, zone["qpf"], hour))
+            else:
+                zone["historicalRain"].clear()
+                decisions.append(False)
+    return np.array(decisions)
+
+def parseRange(text, kind=int):
+    # "6:48:6" (inclusive), "1,2,5" or a single value
+    if ":" in text:
+        start, stop, step = (kind(part) for part in text.split(":"))
+        count = int(round((stop - start) / step)) + 1
+        return [kind(round(start + i * step, 6)) for i in range(count)]
+    return [kind(part) for part in text.split(",")]
+
+def runReplay(args):
+    global np
+    try:
+        import numpy as np
+    except ImportError:
+        print("Replay needs NumPy (sudo apt install python3-numpy).")
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    archive = loadArchive(args.replay)
+    lookAheads = [min(value, 168) for value in parseRange(args.look_ahead)]
+    lookBehinds = [min(value, 168) for value in parseRange(args.look_behind)]
+    limits = parseRange(args.limit, float)
+    print("Replaying %i hour(s) over %i setting(s)..." %
+        (len(archive["lengths"]), len(lookAheads) * len(lookBehinds) * len(limits)))
+
+    started = time.time()
+    with ProcessPoolExecutor(args.workers, initializer=replayWorker, initargs=(args.replay,)) as pool:
+        tasks = [pool.submit(replaySweep, lookAhead, lookBehinds, limits, args.weekly_water)
+                 for lookAhead in lookAheads]
+        results = [result for task in tasks for result in task.result()]
+    print("Done in %.1f seconds." % (time.time() - started))
+
+    header = ("lookAhead", "lookBehind", "rainfallLimit", "disabledHours", "waterSaved", "missedHours", "wetHoursWatered")
+    if args.output:
+        with open(args.output, "w", newline="") as outputFile:
+            writer = csv.writer(outputFile)
+            writer.writerow(header)
+            writer.writerows(results)
+        print("Results written to %s" % args.output)
+    print("\nFewest missed-watering hours, then most water saved (in):")
+    print("%9s %10s %13s %13s %10s %11s %15s" % header)
+    for result in sorted(results, key=lambda result: (result[5], -result[4]))[:args.top]:
+        print("%9i %10i %13.2f %13i %10.2f %11i %15i" % result)
+
+    for i in range(args.verify):
+        lookAhead, lookBehind, limit = random.choice(lookAheads), random.choice(lookBehinds), random.choice(limits)
+        vectorized = replayDecisions(archive, lookAhead, lookBehind, [limit])[1][0]
+        live = replayLive(archive, lookAhead, lookBehind, limit)
+        print("Check against live path, lookAhead %i lookBehind %i limit %s: %s" % (lookAhead,
+            lookBehind, limit, "identical" if np.array_equal(vectorized, live) else
+            "%i hour(s) DIFFER" % (vectorized != live).sum()))
+
+def runAudit(args):
+    # Weekly totals from a zone's long-term archive, read a week at a time
+    # so memory stays bounded however many years it holds
+    global np
+    try:
+        import numpy as np
+    except ImportError:
+        print("Audit needs NumPy (sudo apt install python3-numpy).")
+        return
+    try:
+        archive = RainArchive(args.audit, create=False)
+    except (OSError, ValueError) as e:
+        print("Cannot read archive: %s" % e)
+        return
+    if not len(archive):
+        print("%s is empty." % args.audit)
+        return
+    print("%i hour(s) archived from %s" % (len(archive), time.strftime("%Y-%m-%d %H:00",
+        time.localtime(archive.first * 3600))))
+    header = ("week", "hours", "forecast", "observed", "disabledHours", "meanRate")
+    print("%-10s %6s %9s %9s %14s %9s" % header)
+    for start in range(archive.first, archive.first + len(archive), 168):
+        week = archive.read(start, start + 168)[1]
+        forecast, observed, rainRate, disabled = week.T
+        checked = ~np.isnan(rainRate)
+        print("%-10s %6i %9.2f %9s %14i %9s" % (time.strftime("%Y-%m-%d", time.localtime(start * 3600)),
+            (~np.isnan(forecast)).sum(), np.nansum(forecast),
+            "%.2f" % np.nansum(observed) if (~np.isnan(observed)).any() else "-",
+            np.nansum(disabled), "%.2f" % rainRate[checked].mean() if checked.any() else "-"))
 
 def shutdown(signum, frame):
     global config
     
     print('SIGINT or CTRL-C detected. Exiting.')
-    with open(getCfgFile(),"w") as configFile:
-        json.dump(config, configFile)
-    GPIO.output(Pins.OpenRelay, False) 
-    GPIO.output(Pins.CloseRelay, False) 
-    GPIO.output(Pins.EnabledLED, False) 
-    GPIO.output(Pins.DisabledLED, False) 
+    for zone in zones:
+        if "time" in zone: # Rolling data loaded
+            saveState(zone)
+        if GPIO is None:
+            continue
+        GPIO.output(zone["pins"].OpenRelay, False) 
+        GPIO.output(zone["pins"].CloseRelay, False) 
+        GPIO.output(zone["pins"].EnabledLED, False) 
+        GPIO.output(zone["pins"].DisabledLED, False) 
+    if controlServer:
+        with contextlib.suppress(OSError):
+            os.remove(controlServer.server_address)
     display[1], display[2], display[3], display[4] = "", "", "", ""
     updateOLED()
+    if renderer:
+        renderer.flush()
     exit()
 
 # Main program loop
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Disable sprinklers when rain is predicted.")
+    parser.add_argument("--replay", metavar="ARCHIVE",
+        help="replay an archive of hourly forecasts (CSV) over a sweep of settings, then exit")
+    parser.add_argument("--look-ahead", default="6:72:6", help="hours ahead to sweep, start:stop:step or list")
+    parser.add_argument("--look-behind", default="6:168:6", help="hours behind to sweep")
+    parser.add_argument("--limit", default="0.25:3:0.25", help="rainfall limits to sweep, in/wk")
+    parser.add_argument("--weekly-water", type=float, default=1.0,
+        help="irrigation applied per week when enabled, in inches, for the water saved figure")
+    parser.add_argument("--workers", type=int, default=None, help="replay processes (default: one per core)")
+    parser.add_argument("--output", help="write every replay result to this CSV file")
+    parser.add_argument("--top", type=int, default=10, help="replay results to print")
+    parser.add_argument("--verify", type=int, default=3,
+        help="random settings to check against the live decision path")
+    parser.add_argument("--audit", metavar="ARCHIVE",
+        help="print weekly totals from a zone's long-term archive (.arc), then exit")
+    parser.add_argument("--control", metavar="COMMAND", nargs="+",
+        help="send a command (status, open, close, auto, refresh) to the running controller, then exit")
+    parser.add_argument("--headless", action="store_true", help="run without GPIO or a display")
+    parser.add_argument("--proxy", metavar="PORT", type=int,
+        help="serve forecasts to other controllers on this port instead of driving valves")
+    parser.add_argument("--upstream", default=defaultForecastURL,
+        help="forecast URL the proxy fetches, with %%s placeholders for latitude and longitude")
+    parser.add_argument("--proxy-hold", type=int, default=600,
+        help="seconds the proxy keeps a forecast at least, whatever the upstream allows")
+    parser.add_argument("--proxy-points", type=int, default=1000,
+        help="forecast points the proxy holds at most, least recently asked for dropped first")
+    args = parser.parse_args()
+    headless = args.headless
+    if args.replay:
+        runReplay(args)
+        exit()
+    if args.audit:
+        runAudit(args)
+        exit()
+    if args.control:
+        sendControl(args.control)
+        exit()
+    if args.proxy is not None:
+        runProxy(args)
+        exit()
+
     # Tell Python to run the shutdown() function when SIGINT (CTRL-C) is recieved
     signal(SIGINT, shutdown)
 